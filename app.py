@@ -1,47 +1,37 @@
 # Importing libraries
+import json
+import os
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-import plotly.graph_objs as go
-import pandas as pd
-from plotly.subplots import make_subplots
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import dash_table
 
-from utils import create_polar, create_pairwise, create_gauge
-
-
-# Reading data in as DataFrame
-dfJoined = pd.read_csv("shap.csv", sep='\t')
-# Copy selected columns
-df = dfJoined[["sepal length (cm)_shap", "sepal width (cm)_shap", "petal length (cm)_shap", "petal width (cm)_shap","shift","target"]]
-
-# Storing required column names
-axes =["sepal length", "sepal width", "petal length", "petal width"]
-
-# Renaming the column names for ease of reading
-mapping1 = {dfJoined.columns[1]:axes[0], dfJoined.columns[3]: axes[1], dfJoined.columns[5]:axes[2], dfJoined.columns[7]:axes[3]}
-mapping2 = {df.columns[0]:axes[0], df.columns[1]: axes[1], df.columns[2]:axes[2], df.columns[3]:axes[3]}
-dfJoined = dfJoined.rename(columns=mapping1)
-df=df.rename(columns=mapping2)
-
-# Rounding of decimals to standardize
-df=df.round(decimals=2)
-dfJoined=dfJoined.round(decimals=2)
-
-
-
-# Creating a new DF with shap values in the positive range
-df_norm=df+max(abs(df.min()))
-df_norm['shift'] = dfJoined['shift']
-df_norm['target'] = dfJoined['target']
-
-
-filtered_df = df_norm[df_norm['target']==0]
+from data import current, add_reload_listener
+from cache import figure_cache
+from records import record_columns, query_page
+from metrics import instrument
+from http_cache import enable_http_cache, skip_cache
+from builds import BUILD_POLL_INTERVAL, build_pool
+from precompute import open_store
+from cohorts import cohort_columns, cohort_stats
+from neighbours import NEIGHBOURS, neighbour_records
+from utils import create_pairwise, create_box, create_bubble, create_row_outputs, create_placeholder, build_client_payload, \
+    BOX_LAYOUT, BUBBLE_LAYOUT
+
+# When enabled, the Tab 1 and Tab 3 outputs are computed in the browser
+# from data shipped once in a dcc.Store (see assets/clientside.js)
+CLIENTSIDE_CALLBACKS = os.environ.get("CLIENTSIDE_CALLBACKS", "0") == "1"
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# Tab content is rendered on demand, so the callbacks reference components
+# that are not in the initial layout. Compression is set up with the HTTP
+# cache by enable_http_cache
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
+                suppress_callback_exceptions=True, compress=False)
 server = app.server
 
 # Setting some group styling
@@ -86,45 +76,27 @@ chart_box = {
   'backgroundColor':colors['background'],
   'plot_bgcolor': colors['background']
 }
-target_options = []
-
-# Storing the class names based on class numbers 0 or 1
-for cls in range(0,2):
-    if cls == 0:
-        target_options.append({'label':'Class Not Versicolor','value':cls})
-    else:
-        target_options.append({'label':'Class Versicolor','value':cls})
-
-
-# Initializing fig
-fig = make_subplots(rows=1,cols=2,shared_yaxes= True,
-                    specs=[[{'type': 'polar'}]*2],
-                     subplot_titles=("Selected Record","Represented Class"))
 
+def render_tab1():
+    """
+    Function to build the content of Tab 1
+    Arguments: None
+    Returns:
+        Div with the class picker, box plot and bubble chart
 
-# Creating pairwise plot as its not dependent on callbacks
-fig5 = create_pairwise()
-
-
-# website layout
-app.layout = html.Div([
-
-    html.H2("Interactive Data Driven Visualization Dashboard", style={'text-align':'center','font-family':'sans-serif'}),
-
-    # All tabs
-    dcc.Tabs(id="tabs-styled-with-inline", value='tab-1', children=[
-        # Tab 1
-        dcc.Tab(label='Class-specific Multi-Attribute Comparison', value='tab-1', style=tab_style,
-        selected_style=tab_selected_style, children = [
-        html.Div([
+    """
+    dataset = current()
+    return html.Div([
             # Div for Dropdown and H3
             html.Div([
             html.Div([],className="b-container"),
             html.H6(
-                'Select a class from the dropdown to view Class-specific behaviour of petals and sepals'
+                'Select a class from the dropdown to view Class-specific behaviour of its top features'
             ,style={'text-align':'center','font-family':'sans-serif', 'color': colors['text']}),
-            dcc.Dropdown(id='class-picker',options=target_options,
-            value = dfJoined['target'].max(), style={'width':'100%', 'text-align':'center', 'color':colors["text"]})
+            # Persistence keeps the selection when switching tabs re-renders the picker
+            dcc.Dropdown(id='class-picker',options=dataset.target_options,
+            value = dataset.dfJoined['target'].max(), persistence=True,
+            style={'width':'100%', 'text-align':'center', 'color':colors["text"]})
             ],  className = "container"),
 
             # Adding vertical space
@@ -140,16 +112,42 @@ app.layout = html.Div([
             html.Div([
                 dcc.Graph(
                     id='graph2')
-            ],style=graph_style, className="five columns")
+            ],style=graph_style, className="five columns"),
+
+            # Polls the class figures while they are built in the background
+            dcc.Interval(id='class-poll', interval=BUILD_POLL_INTERVAL*1000, disabled=True)
 
         ], style = {"textAlign":"center"},className="row")
 
-        ]),
 
-        # Tab 2
-        dcc.Tab(label='Pair-wise Attribute Comparison of Universe', value='tab-2', style=tab_style,
-        selected_style=tab_selected_style, children = [
-        html.Div([
+def get_pairwise():
+    """
+    Function to get the scatter matrix, built in the background when it is slow
+    Arguments: None
+    Returns:
+        Figure, or a placeholder, and whether it is the current one
+
+    """
+    dataset = current()
+    figure, ready = build_pool.get(('pairwise', dataset.version), ('pairwise',),
+                                   lambda: create_pairwise(dataset=dataset))
+    if not ready:
+        skip_cache()
+    return figure or create_placeholder(), ready
+
+
+def render_tab2():
+    """
+    Function to build the content of Tab 2
+    Arguments: None
+    Returns:
+        Div with the pair-wise scatter matrix
+
+    """
+    # Pairwise plot is not dependent on callbacks, so it is built once per dataset version
+    fig5, ready = get_pairwise()
+
+    return html.Div([
 
 
             # Adding vertical space
@@ -160,35 +158,78 @@ app.layout = html.Div([
                     'Comparison of pair-wise interaction between the attributes for each class'
                 ,style={'text-align':'center','font-family':'sans-serif'}),
                 dcc.Graph(
-                    id='graph5',figure = fig5)
+                    id='graph5',figure = fig5),
+                # Polls the scatter matrix while it is built in the background
+                dcc.Interval(id='pairwise-poll', interval=BUILD_POLL_INTERVAL*1000, disabled=ready)
             ], style= chart_box)
         ], className="row")
 
-        ]),
-        # Tab 3
-        dcc.Tab(label='Instance-specific Multi-Attribute Comparison', value='tab-3', style=tab_style,
-        selected_style=tab_selected_style, children=[
-        html.Div([
+
+def render_tab3():
+    """
+    Function to build the content of Tab 3
+    Arguments: None
+    Returns:
+        Div with the record browser, row picker, polar chart and gauge chart
+
+    """
+    dataset = current()
+    last_row = len(dataset.df) - 1
+    # Cohorts are aggregated on the server, so the selectors are only offered
+    # when the charts are rendered there
+    cohort_selectors = [] if CLIENTSIDE_CALLBACKS else [
+            html.Div([],className="b-container"),
+            html.H6(
+                'Compare it with its class, or with the records whose value of a column lies in a range'
+            ,style={'font-family':'sans-serif', 'text-align':'center','color':colors["text"]},),
+            dcc.Dropdown(id='cohort-column',
+            options=[{'label': col, 'value': col} for col in cohort_columns(dataset)],
+            placeholder="Class of the record", persistence=True,
+            style={'width':'100%', 'text-align':'center', 'color':colors["text"]}),
+            html.Div([
+            dcc.Input(id='cohort-min', type="number", placeholder="From", debounce=True, persistence=True,
+            style = {"width":"50%", "text-align":'center','color':colors["text"]}),
+            dcc.Input(id='cohort-max', type="number", placeholder="To", debounce=True, persistence=True,
+            style = {"width":"50%", "text-align":'center','color':colors["text"]})
+            ])]
+    return html.Div([
+            # Div for vertical space
+            html.Div([],className="b-container"),
+            # Div for the record browser, paged, sorted and filtered on the server
+            html.Div([
+            html.H6(
+                'Find a record by filtering and sorting the table, then select it to visualize and compare'
+            ,style={'font-family':'sans-serif', 'text-align':'center','color':colors["text"]},),
+            dash_table.DataTable(id='record-table',
+                columns=[{'name': 'record', 'id': 'record'}] +
+                        [{'name': col, 'id': col, 'type': 'numeric'} for col in record_columns(dataset)],
+                page_current=0, page_size=10, page_action='custom',
+                sort_action='custom', sort_mode='single', sort_by=[],
+                filter_action='custom', filter_query='',
+                row_selectable='single', selected_rows=[],
+                style_table={'overflowX': 'auto'},
+                style_cell={'font-family':'sans-serif', 'text-align':'center'})
+            ], className = "container"),
             # Div for vertical space
             html.Div([],className="b-container"),
             # Div for Input
             html.Div([
             html.H6(
-                'Enter the record number between 0 and 37 you would like to visualize and compare'
+                'Or enter the record number between 0 and {} you would like to visualize and compare'.format(last_row)
             ,style={'font-family':'sans-serif', 'text-align':'center','color':colors["text"]},),
             html.Div([
             dcc.Input(id='row-picker', value=0, type="number",
-            debounce=False,min=0,max=37, placeholder="Enter below 37 ",
+            debounce=False,min=0,max=last_row, placeholder="Enter up to {} ".format(last_row), persistence=True,
             style = {"width":"100%", "text-align":'center','color':colors["text"]})
             ]),
             html.Div(id="class_display",style = {"width":"100%", "text-align":'center','color':colors["text"]})
-            ], className = "container"),
+            ] + cohort_selectors, className = "container"),
         # Div for vertical space
         html.Div([],className="b-container"),
         # Div for Polar chart
         html.Div([
             dcc.Graph(
-                id='graph3',figure=fig)
+                id='graph3')
             ], style=graph_style,className="five columns"),
 
         # Div for Gauge chart
@@ -196,149 +237,274 @@ app.layout = html.Div([
             html.H6("Selected Record Vs Represented Class Single-Attribute Comparison"
             ,style={'text-align':'center','font-family':'sans-serif'}),
             dcc.Graph(
-                id='graph4',figure=fig)
-            ], style=graph_style,className="six columns")
+                id='graph4')
+            ], style=graph_style,className="six columns"),
 
+        # Div for the nearest records in SHAP space
+        html.Div([
+            html.Div([],className="b-container"),
+            html.H6(
+                'The {} records explained most like the selected one (closest SHAP values)'.format(NEIGHBOURS)
+            ,style={'font-family':'sans-serif', 'text-align':'center','color':colors["text"]},),
+            dash_table.DataTable(id='neighbour-table',
+                columns=[{'name': 'record', 'id': 'record'}, {'name': 'distance', 'id': 'distance', 'type': 'numeric'}] +
+                        [{'name': col, 'id': col, 'type': 'numeric'} for col in record_columns(dataset)],
+                style_table={'overflowX': 'auto'},
+                style_cell={'font-family':'sans-serif', 'text-align':'center'})
+            ], className = "container")
 
-        ], className = "row")
 
-        ])
+        ], className = "row")
 
-        ], style=tabs_styles)
 
+tab_renderers = {'tab-1': render_tab1, 'tab-2': render_tab2, 'tab-3': render_tab3}
 
-])
 
-# Callback for Tab 1 Graph 1
-@app.callback(Output('graph1','figure'),
-        [Input('class-picker','value')])
-def update_figure(selected_class):
+# website layout
+# Only the tab headers are shipped up front; the content of the selected
+# tab is rendered on demand by render_content
+def serve_layout():
     """
-    Function to update the graph based on selected class
-    Arguments:
-        selected_class: class selected as integer
+    Function to build the page layout, evaluated on every page load
+    Arguments: None
     Returns:
-        Updated box plot object
+        Div with the tab headers and the content placeholder
 
     """
-    filtered_df = dfJoined[dfJoined['target']==selected_class]
-    filtered_df2 = df_norm[df_norm['target']==selected_class]
+    children = [
+
+    html.H2("Interactive Data Driven Visualization Dashboard", style={'text-align':'center','font-family':'sans-serif'}),
+
+    # All tabs
+    dcc.Tabs(id="tabs-styled-with-inline", value='tab-1', children=[
+        # Tab 1
+        dcc.Tab(label='Class-specific Multi-Attribute Comparison', value='tab-1', style=tab_style,
+        selected_style=tab_selected_style),
+
+        # Tab 2
+        dcc.Tab(label='Pair-wise Attribute Comparison of Universe', value='tab-2', style=tab_style,
+        selected_style=tab_selected_style),
+        # Tab 3
+        dcc.Tab(label='Instance-specific Multi-Attribute Comparison', value='tab-3', style=tab_style,
+        selected_style=tab_selected_style)
 
-    #axes =["sepal length (cm)_shap", "sepal width (cm)_shap", "petal length (cm)_shap", "petal width (cm)_shap"]
+        ], style=tabs_styles),
 
-    traces=[]
+    # Content of the selected tab
+    html.Div(id='tabs-content')
 
+    ]
 
-    #print(filtered_df.head())
-    for axis in axes:
-        [traces.append(go.Box(
-            #x=filtered_df['shift'],
-            y=filtered_df[axis],
-            name=axis
-            ))]
+    # Store holding the compact per-row and per-class arrays for the browser,
+    # built once per dataset version
+    if CLIENTSIDE_CALLBACKS:
+        dataset = current()
+        children.append(dcc.Store(id='dashboard-data', data=figure_cache.get_or_create(
+            ('client_payload', dataset.version), lambda: build_client_payload(dataset))))
 
+    return html.Div(children)
 
 
-    return {'data':traces,
-                'layout':go.Layout(title='Class-specific Comparison between Attributes (Box Plot)',
-                                    #xaxis={'title':'Shift'},
-                                    yaxis={'title':'Sepal and Petal attributes'},
-                                        hovermode='closest',
-                                        paper_bgcolor='rgba(233,233,233,0)',
-                                        plot_bgcolor='rgba(255,233,0,0)')}
+app.layout = serve_layout
 
-# Callback for Tab 1 Graph 2
-@app.callback(Output('graph2','figure'),
-        [Input('class-picker','value')])
-def update_figure(selected_class):
+def drop_stale_figures(old, new):
     """
-    Function to update the graph based on selected class
+    Function to forget the figures of a replaced dataset
     Arguments:
-        selected_class: class selected as integer
-    Returns:
-        Updated Bubble chart object
+        old: replaced snapshot
+        new: snapshot swapped in
+    Returns: None
 
     """
+    figure_cache.clear()
+    if figure_cache.backend is not None and new.version != old.version:
+        figure_cache.backend.drop(old.version)
 
-    filtered_df = dfJoined[dfJoined['target']==selected_class]
-    filtered_df2 = df_norm[df_norm['target']==selected_class]
-
-    traces2=[]
-    #print(filtered_df.head())
-    for axis in axes:
-        [traces2.append(go.Scatter(
-            x=filtered_df['shift'],
-            y=filtered_df[axis],
-            text=["shift, "+axis],
-            mode='markers',
-            opacity=0.7,
-            marker=dict(size=10*(filtered_df2[axis])),
-            name=axis
-            ))]
 
+# Figures cached for a replaced dataset can never be served again
+add_reload_listener(drop_stale_figures)
 
+# Callback for rendering the selected tab
+@app.callback(Output('tabs-content','children'),
+        [Input('tabs-styled-with-inline','value')])
+def render_content(tab):
+    """
+    Function to render the content of the selected tab
+    Arguments:
+        tab: value of the selected tab
+    Returns:
+        Div with the tab content
 
-    return {'data':traces2,
-                'layout':go.Layout(title='Class-specific Comparison between Attributes (Bubble Chart)',
-                                    xaxis={'title':'Shift'},
-                                    yaxis={'title':'Sepal and Petal attributes'},
-                                        hovermode='closest',
-                                         paper_bgcolor='rgba(233,233,233,0)',
-                                         plot_bgcolor='rgba(255,233,0,0)')}
+    """
+    return tab_renderers[tab]()
 
+# Callback for Tab 1 - Box plot and Bubble chart
+def update_class_figures(selected_class, n_intervals=None):
+    """
+    Function to update both Tab 1 graphs based on selected class
+    Arguments:
+        selected_class: class selected as integer
+        n_intervals: polls made while the figures are built
+    Returns:
+        Updated box plot and bubble chart objects, and whether polling stops
 
-# Callback for Tab 3 Graph 1
-@app.callback(Output('graph3','figure'),
-        [Input('row-picker','value')])
-def update_figure(selected_row):
     """
-    Function to update the graph based on selected row
+    dataset = current()
+    # A cleared picker, or a persisted class gone after a reload, gets empty charts
+    if selected_class not in dataset.class_index:
+        return [{'data': [], 'layout': BOX_LAYOUT}, {'data': [], 'layout': BUBBLE_LAYOUT}, True]
+    # Figures rendered by precompute.py are served as they are
+    store = open_store(dataset)
+    figures = store.class_figures(selected_class) if store is not None else None
+    if figures is not None:
+        return json.loads(figures) + [True]
+    # Class is resolved once and shared by both figures
+    class_data = dataset.class_index[selected_class]
+    figures, ready = build_pool.get(('class', selected_class, dataset.version), ('class', selected_class),
+                                    lambda: [create_box(class_data, dataset=dataset),
+                                             create_bubble(class_data, dataset=dataset)])
+    if not ready:
+        # The placeholder is only sent once; polls wait for the real figures
+        polled = [item['prop_id'] for item in dash.callback_context.triggered] == ['class-poll.n_intervals']
+        if polled:
+            raise PreventUpdate
+        skip_cache()
+    return (figures or [create_placeholder(), create_placeholder()]) + [ready]
+
+
+# Callback for Tab 2 - Scatter matrix, once its background build is done
+@app.callback([Output('graph5','figure'), Output('pairwise-poll','disabled')],
+        [Input('pairwise-poll','n_intervals')])
+def poll_pairwise(n_intervals):
+    """
+    Function to replace the placeholder of the scatter matrix when it is built
     Arguments:
-        selected_row: row selected as integer
+        n_intervals: polls made so far
     Returns:
-        Updated Polar bar chart object
+        Scatter matrix and True to stop polling
 
     """
-    fig = create_polar(selected_row)
-    return fig
+    if not n_intervals:
+        raise PreventUpdate
+    figure, ready = get_pairwise()
+    if not ready:
+        raise PreventUpdate
+    return figure, True
 
-# Callback for Tab 3 Graph 2
-@app.callback(Output('graph4','figure'),
-        [Input('row-picker','value')])
-def update_figure(selected_row):
 
+# Callback for Tab 3 - Polar chart, Gauge chart and Div tag to display class
+def update_row_outputs(selected_row, cohort_column=None, cohort_min=None, cohort_max=None):
     """
-    Function to update the graph based on selected row
+    Function to update all Tab 3 outputs based on selected row
     Arguments:
         selected_row: row selected as integer
+        cohort_column: column selecting the cohort compared with, the class of the row when empty
+        cohort_min, cohort_max: range of the cohort column, open when empty
+    Returns:
+        Updated Polar bar chart, guage object and class value as string
+
+    """
+    dataset = current()
+    # Empty, fractional or out-of-range input keeps the current charts
+    if selected_row is None or selected_row != int(selected_row) or not 0 <= selected_row < len(dataset.df):
+        raise PreventUpdate
+    selected_row = int(selected_row)
+    if cohort_column:
+        # An empty cohort falls back to the class of the record
+        cohort = cohort_stats(dataset, cohort_column, cohort_min, cohort_max)
+        if cohort is not None:
+            return figure_cache.get_or_create(
+                ('row', selected_row, cohort_column, cohort_min, cohort_max, dataset.version),
+                lambda: create_row_outputs(selected_row, dataset, cohort))
+    # Outputs rendered by precompute.py are served as they are
+    store = open_store(dataset)
+    outputs = store.row_outputs(selected_row) if store is not None else None
+    if outputs is not None:
+        return json.loads(outputs)
+    return figure_cache.get_or_create(('row', selected_row, dataset.version),
+                                      lambda: create_row_outputs(selected_row, dataset))
+
+
+# Callback for Tab 3 - One page of the record browser
+@app.callback([Output('record-table','data'), Output('record-table','page_count'),
+               Output('record-table','selected_rows')],
+        [Input('record-table','page_current'), Input('record-table','page_size'),
+         Input('record-table','sort_by'), Input('record-table','filter_query')])
+def update_record_table(page_current, page_size, sort_by, filter_query):
+    """
+    Function to serve the requested page of the record browser
+    Arguments:
+        page_current: page number
+        page_size: rows per page
+        sort_by: column and direction to sort on
+        filter_query: filter typed in the table header
     Returns:
-        Updated guage object
+        Records of the page, number of pages and cleared selection
 
     """
-    fig = create_gauge(selected_row)
-    return fig
+    records, page_count = query_page(current(), page_current or 0, page_size, sort_by, filter_query)
+    return records, page_count, []
 
 
-# Callback for Tab 3 - Div tag to display class
-@app.callback(
-    Output(component_id='class_display', component_property='children'),
-    [Input(component_id='row-picker', component_property='value')]
-)
-def update_output_div(input_value):
+# Callback for Tab 3 - Nearest records of the selected one
+@app.callback(Output('neighbour-table','data'),
+        [Input('row-picker','value')])
+def update_neighbours(selected_row):
     """
-    Function to update the graph based on selected row
+    Function to list the records closest to the selected row in SHAP space
     Arguments:
         selected_row: row selected as integer
     Returns:
-        Updated Class value as string
+        Records of the nearest rows, nearest first
 
     """
-    row = input_value
-    sample_df = df.iloc[row:row+1]
-    target_class = sample_df['target'].values[0]
+    dataset = current()
+    if selected_row is None or selected_row != int(selected_row) or not 0 <= selected_row < len(dataset.df):
+        raise PreventUpdate
+    return neighbour_records(dataset, int(selected_row))
+
 
-    return 'Class of selected record: "{}"'.format(target_options[target_class]['label'])
+# Callback for Tab 3 - Selecting a record in the browser drives the charts
+@app.callback(Output('row-picker','value'),
+        [Input('record-table','selected_rows')],
+        [State('record-table','data')])
+def select_record(selected_rows, records):
+    """
+    Function to copy the selected record number into the row picker
+    Arguments:
+        selected_rows: positions of the selected rows in the page
+        records: records of the page
+    Returns:
+        Record number of the selection
 
+    """
+    if not selected_rows or not records or selected_rows[0] >= len(records):
+        raise PreventUpdate
+    return records[selected_rows[0]]['record']
+
+
+if CLIENTSIDE_CALLBACKS:
+    # Browser-executed callbacks, one per output
+    for output, function_name, input_id in [(Output('graph1', 'figure'), 'boxFigure', 'class-picker'),
+                                            (Output('graph2', 'figure'), 'bubbleFigure', 'class-picker'),
+                                            (Output('graph3', 'figure'), 'polarFigure', 'row-picker'),
+                                            (Output('graph4', 'figure'), 'gaugeFigure', 'row-picker'),
+                                            (Output('class_display', 'children'), 'classLabel', 'row-picker')]:
+        app.clientside_callback(ClientsideFunction(namespace='dashboard', function_name=function_name),
+                                output, [Input(input_id, 'value')], [State('dashboard-data', 'data')])
+else:
+    app.callback([Output('graph1','figure'), Output('graph2','figure'), Output('class-poll','disabled')],
+            [Input('class-picker','value'), Input('class-poll','n_intervals')])(update_class_figures)
+    app.callback([Output('graph3','figure'), Output('graph4','figure'),
+                  Output(component_id='class_display', component_property='children')],
+            [Input('row-picker','value'), Input('cohort-column','value'),
+             Input('cohort-min','value'), Input('cohort-max','value')])(update_row_outputs)
+
+# ETags, 304s and cached gzip bodies for the callbacks and the layout
+enable_http_cache(app)
+
+# Latency, payload and error metrics of every callback, served on /metrics
+instrument(app)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+// Clientside callbacks, used when the app runs with CLIENTSIDE_CALLBACKS=1.
+//
+// They read the compact arrays shipped once in the "dashboard-data" store
+// and patch the same figure templates as create_polar, create_gauge,
+// create_box and create_bubble in utils.py, so no request reaches the
+// server when the class or row changes.
+(function() {
+    // Row positions of each class, computed once per page
+    var classRows = {};
+
+    function rowsOfClass(data, cls) {
+        if (!(cls in classRows)) {
+            var rows = [];
+            for (var i = 0; i < data.target.length; i++) {
+                if (data.target[i] === cls) {
+                    rows.push(i);
+                }
+            }
+            classRows[cls] = rows;
+        }
+        return classRows[cls];
+    }
+
+    function pick(values, rows) {
+        return rows.map(function(i) { return values[i]; });
+    }
+
+    function validRow(data, row) {
+        // Whole numbers only, as on the server
+        return Number.isInteger(row) && row >= 0 && row < data.target.length;
+    }
+
+    function validClass(data, cls) {
+        return cls !== null && cls !== undefined && String(cls) in data.mean;
+    }
+
+    function assign(target, source) {
+        return Object.assign({}, target, source);
+    }
+
+    window.dash_clientside = assign(window.dash_clientside, {
+        dashboard: {
+            boxFigure: function(selectedClass, data) {
+                if (!data || !validClass(data, selectedClass)) {
+                    return window.dash_clientside.no_update;
+                }
+                var rows = rowsOfClass(data, selectedClass);
+                var traces = data.top[String(selectedClass)].map(function(axis) {
+                    return {type: 'box', y: pick(data.shap[axis], rows), name: axis};
+                });
+                return {data: traces, layout: data.templates.box};
+            },
+
+            bubbleFigure: function(selectedClass, data) {
+                if (!data || !validClass(data, selectedClass)) {
+                    return window.dash_clientside.no_update;
+                }
+                var rows = rowsOfClass(data, selectedClass);
+                var shift = pick(data.shift, rows);
+                var traces = data.top[String(selectedClass)].map(function(axis) {
+                    return {
+                        type: 'scatter',
+                        x: shift,
+                        y: pick(data.shap[axis], rows),
+                        text: ['shift, ' + axis],
+                        mode: 'markers',
+                        opacity: 0.7,
+                        marker: {size: pick(data.norm[axis], rows).map(function(v) { return 10 * v; })},
+                        name: axis
+                    };
+                });
+                return {data: traces, layout: data.templates.bubble};
+            },
+
+            polarFigure: function(row, data) {
+                if (!data || !validRow(data, row)) {
+                    return window.dash_clientside.no_update;
+                }
+                var cls = String(data.target[row]);
+                var template = data.templates.polar[cls];
+                var title = 'Comparison of Record "' + row + '" Vs "' + data.labels[cls] + '" Average';
+                return {
+                    data: [
+                        assign(template.data[0], {r: data.top[cls].map(function(axis) { return data.norm[axis][row]; })}),
+                        assign(template.data[1], {r: data.norm_mean[cls]})
+                    ],
+                    layout: assign(template.layout, {title: assign(template.layout.title, {text: title})})
+                };
+            },
+
+            gaugeFigure: function(row, data) {
+                if (!data || !validRow(data, row)) {
+                    return window.dash_clientside.no_update;
+                }
+                var cls = String(data.target[row]);
+                var top = data.top[cls];
+                var n = top.length;
+                var template = data.templates.gauge[cls];
+                var mean = data.mean[cls];
+                var traces = top.map(function(axis, i) {
+                    var trace = template.data[i];
+                    return assign(trace, {value: data.shap[axis][row],
+                                          delta: assign(trace.delta, {reference: mean[i]})});
+                });
+                top.forEach(function(axis, i) {
+                    traces.push(assign(template.data[n + i], {value: mean[i]}));
+                });
+                return {data: traces, layout: template.layout};
+            },
+
+            classLabel: function(row, data) {
+                if (!data || !validRow(data, row)) {
+                    return window.dash_clientside.no_update;
+                }
+                return 'Class of selected record: "' + data.labels[String(data.target[row])] + '"';
+            }
+        }
+    });
+})();
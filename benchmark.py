@@ -0,0 +1,254 @@
+# Benchmark suite for the dashboard
+#
+# Generates synthetic SHAP exports of the requested sizes and, for each one,
+# starts a fresh interpreter that imports the app on that file and measures:
+#   - data load time (import of data.py) and app import time
+#   - p50/p99 latency and response bytes of every callback, called through
+#     the Flask test client exactly as the browser would
+#   - peak resident memory of the process
+# One JSON object per dataset size is written to stdout (or --output), so
+# runs of different versions can be diffed or loaded into a notebook.
+#
+#   python benchmark.py --rows 100 10000 1000000 --classes 2 --format columnar
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# Feature names of the shipped export, used first so the default schema matches shap.csv
+IRIS_FEATURES = ["sepal length (cm)", "sepal width (cm)", "petal length (cm)", "petal width (cm)"]
+
+
+def synthetic_export(rows, classes=2, features=4, seed=0):
+    """
+    Function to generate a synthetic SHAP export with the layout written by shap.py
+
+    Arguments:
+        rows: number of records
+        classes: number of target classes
+        features: number of features
+        seed: seed of the random generator
+    Returns:
+        DataFrame with feature, SHAP, margin, shift, prob and target columns
+    """
+    rng = np.random.RandomState(seed)
+    names = IRIS_FEATURES[:features] + ["feature {}".format(i) for i in range(len(IRIS_FEATURES), features)]
+    target = rng.randint(0, classes, size=rows)
+    frame = {}
+    shap_total = np.zeros(rows)
+    for i, name in enumerate(names):
+        # Each class gets its own mean contribution so the class charts differ
+        shap_values = rng.normal(loc=(target - classes / 2.0) * (i % 3 - 1), scale=1.0, size=rows)
+        frame[name] = rng.uniform(0, 8, size=rows)
+        frame[name + "_shap"] = shap_values
+        shap_total += shap_values
+    expected_value = -1.0
+    frame["versicolor_margin"] = shap_total + expected_value
+    frame["shift"] = shap_total
+    frame["versicolor_prob"] = 1 / (1 + np.exp(-frame["versicolor_margin"]))
+    frame["target"] = target
+    return pd.DataFrame(frame)
+
+
+def write_export(frame, directory, data_format):
+    """
+    Function to write a synthetic export in the format served by the app
+
+    Arguments:
+        frame: DataFrame built by synthetic_export
+        directory: directory to write into
+        data_format: "tsv" or "columnar"
+    Returns:
+        Path to use as DATA_PATH
+    """
+    if data_format == "columnar":
+        from columnar import ColumnarWriter
+        path = os.path.join(directory, "shap_data")
+        with ColumnarWriter(path, frame.columns) as writer:
+            writer.append(frame)
+    else:
+        path = os.path.join(directory, "shap.csv")
+        frame.to_csv(path, sep='\t', index=False)
+    return path
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {'p50_ms': round(float(np.percentile(samples, 50)), 3),
+            'p99_ms': round(float(np.percentile(samples, 99)), 3),
+            'calls': len(samples)}
+
+
+def dash_request(outputs, inputs, state=()):
+    # Body of a _dash-update-component request, as sent by the renderer
+    if len(outputs) == 1:
+        output = '{}.{}'.format(*outputs[0])
+        outputs_spec = {'id': outputs[0][0], 'property': outputs[0][1]}
+    else:
+        output = '..' + '...'.join('{}.{}'.format(*o) for o in outputs) + '..'
+        outputs_spec = [{'id': o[0], 'property': o[1]} for o in outputs]
+    return {
+        'output': output,
+        'outputs': outputs_spec,
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': ['{}.{}'.format(i, p) for i, p, v in inputs],
+    }
+
+
+def time_callback(client, body):
+    start = time.perf_counter()
+    response = client.post('/_dash-update-component', json=body)
+    elapsed = time.perf_counter() - start
+    if response.status_code not in (200, 204):
+        raise RuntimeError("{} returned {}".format(body['output'], response.status_code))
+    return elapsed, len(response.get_data())
+
+
+def run_worker(repeat, seed):
+    """
+    Function to benchmark the app on DATA_PATH in this process
+
+    Arguments:
+        repeat: calls per callback
+        seed: seed used to pick the rows and classes requested
+    Returns:
+        Dict of measurements
+    """
+    start = time.perf_counter()
+    import data
+    load_seconds = time.perf_counter() - start
+    import app
+    import_seconds = time.perf_counter() - start
+    from builds import build_pool
+    from cache import figure_cache
+    from http_cache import compressed_cache
+
+    def clear_caches():
+        # Figures and responses cached in memory; the indexes of the snapshot are kept
+        figure_cache.clear()
+        compressed_cache.clear()
+        build_pool.clear()
+
+    dataset = data.current()
+    rows = len(dataset.df)
+    classes = sorted(dataset.class_index)
+    rng = np.random.RandomState(seed)
+    client = app.server.test_client()
+
+    cases = {
+        'class_figures': lambda i: dash_request([('graph1', 'figure'), ('graph2', 'figure'), ('class-poll', 'disabled')],
+                                                [('class-picker', 'value', int(classes[i % len(classes)])),
+                                                 ('class-poll', 'n_intervals', None)]),
+        'row_outputs': lambda i: dash_request([('graph3', 'figure'), ('graph4', 'figure'), ('class_display', 'children')],
+                                              [('row-picker', 'value', int(rng.randint(rows))),
+                                               ('cohort-column', 'value', None),
+                                               ('cohort-min', 'value', None),
+                                               ('cohort-max', 'value', None)]),
+        'cohort_row_outputs': lambda i: dash_request([('graph3', 'figure'), ('graph4', 'figure'), ('class_display', 'children')],
+                                                     [('row-picker', 'value', int(rng.randint(rows))),
+                                                      ('cohort-column', 'value', 'shift'),
+                                                      ('cohort-min', 'value', round(float(rng.uniform(-1, 0)), 2)),
+                                                      ('cohort-max', 'value', None)]),
+        'neighbours': lambda i: dash_request([('neighbour-table', 'data')],
+                                             [('row-picker', 'value', int(rng.randint(rows)))]),
+        'pairwise_tab': lambda i: dash_request([('tabs-content', 'children')],
+                                               [('tabs-styled-with-inline', 'value', 'tab-2')]),
+        'record_page': lambda i: dash_request([('record-table', 'data'), ('record-table', 'page_count'), ('record-table', 'selected_rows')],
+                                              [('record-table', 'page_current', int(rng.randint(max(1, rows // 10)))),
+                                               ('record-table', 'page_size', 10),
+                                               ('record-table', 'sort_by', [{'column_id': 'shift', 'direction': 'desc'}]),
+                                               ('record-table', 'filter_query', '{shift} ge 0')]),
+    }
+
+    callbacks = {}
+    for name, make_body in cases.items():
+        # The first call pays for caches and lazily built indexes
+        clear_caches()
+        before = figure_cache.stats()
+        first, first_bytes = time_callback(client, make_body(0))
+        cold, warm, sizes = [], [], []
+        for i in range(repeat):
+            # Each request is timed with the caches cleared, then repeated as a cache hit
+            body = make_body(i)
+            clear_caches()
+            elapsed, size = time_callback(client, body)
+            cold.append(elapsed)
+            sizes.append(size)
+            elapsed, _ = time_callback(client, body)
+            warm.append(elapsed)
+        result = percentiles(cold)
+        result.update(('warm_' + key, value) for key, value in percentiles(warm).items() if key != 'calls')
+        result['first_ms'] = round(first * 1000, 3)
+        result['response_bytes'] = int(np.max(sizes + [first_bytes]))
+        after = figure_cache.stats()
+        result['cache_hits'] = after['hits'] - before['hits']
+        result['cache_misses'] = after['misses'] - before['misses']
+        callbacks[name] = result
+
+    layout = client.get('/_dash-layout')
+    return {
+        'rows': rows,
+        'classes': len(classes),
+        'data_load_s': round(load_seconds, 4),
+        'app_import_s': round(import_seconds, 4),
+        'layout_bytes': len(layout.get_data()),
+        'callbacks': callbacks,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard on synthetic SHAP exports")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--features", type=int, default=4)
+    parser.add_argument("--format", choices=["tsv", "columnar"], default="tsv")
+    parser.add_argument("--repeat", type=int, default=50, help="calls per callback")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON lines to, stdout by default")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.repeat, args.seed)))
+        return
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    here = os.path.dirname(os.path.abspath(__file__))
+    for rows in args.rows:
+        directory = tempfile.mkdtemp(prefix="shap_bench_")
+        try:
+            start = time.perf_counter()
+            path = write_export(synthetic_export(rows, args.classes, args.features, args.seed), directory, args.format)
+            generate_seconds = time.perf_counter() - start
+            # Slow figures are built in the request, so their full latency is measured,
+            # and the shared figure cache is off so no run reads or pollutes it
+            env = dict(os.environ, DATA_PATH=path, DATA_RELOAD_INTERVAL="0", BUILD_THREADS="0",
+                       FIGURE_CACHE_DIR="")
+            worker = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker",
+                                     "--repeat", str(args.repeat), "--seed", str(args.seed)],
+                                    cwd=here, env=env, stdout=subprocess.PIPE, check=True)
+            result = json.loads(worker.stdout.decode().strip().splitlines()[-1])
+            result.update({'format': args.format, 'features': args.features,
+                           'generate_s': round(generate_seconds, 4)})
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
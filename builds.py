@@ -0,0 +1,119 @@
+# Background figure builds
+#
+# A large class's box and bubble charts or the scatter matrix can take
+# seconds to build, and under sync gunicorn workers the request building
+# them holds a whole worker. Such builds are handed to a small thread pool
+# instead: the request waits at most BUILD_TIMEOUT seconds, then answers
+# with the last figure built for the same view (or a placeholder) and the
+# page polls until the build is done. Identical requests arriving while a
+# build runs wait on that build rather than starting another one. At most
+# BUILD_MAX_PENDING builds are queued or running; beyond that a request for
+# a new figure is answered at once with the fallback, and its page polls
+# until a slot frees up.
+#
+# Finished builds go to the figure cache, so they are served to every
+# later request like any other cached figure.
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from plotly.utils import PlotlyJSONEncoder
+
+from cache import figure_cache
+
+
+# Threads building figures in the background; 0 builds them in the request
+BUILD_THREADS = int(os.environ.get("BUILD_THREADS", 2))
+# Seconds a request waits for a build before answering with a placeholder
+BUILD_TIMEOUT = float(os.environ.get("BUILD_TIMEOUT", 2))
+# Seconds between two polls of the page while a build runs
+BUILD_POLL_INTERVAL = float(os.environ.get("BUILD_POLL_INTERVAL", 1))
+# Builds queued or running at once; further distinct figures wait for a slot
+BUILD_MAX_PENDING = int(os.environ.get("BUILD_MAX_PENDING", 8))
+
+
+class BuildPool(object):
+    """
+    Bounded pool building figures once per key, in the background
+
+    Arguments:
+        cache: FigureCache receiving the built figures
+        threads: number of build threads; builds run in the caller when 0
+        max_pending: builds queued or running at once
+    """
+
+    def __init__(self, cache, threads=BUILD_THREADS, max_pending=BUILD_MAX_PENDING):
+        self.cache = cache
+        self.max_pending = max_pending
+        self.last_good = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="build") if threads > 0 else None
+
+    def _build(self, key, slot, builder):
+        try:
+            value = json.dumps(builder(), cls=PlotlyJSONEncoder)
+            self.cache.set(key, value)
+            # Kept even when too large for the cache, so a poll can collect it
+            with self._lock:
+                self.last_good[slot] = (key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def get(self, key, slot, builder, timeout=BUILD_TIMEOUT):
+        """
+        Function to return a figure, building it in the background on a miss
+
+        Arguments:
+            key: figure cache key
+            slot: view the figure is shown in, e.g. ("class", 1); the last
+                figure built for it is the fallback of a slow build
+            builder: zero-argument function returning the figure
+            timeout: seconds to wait for a build
+        Returns:
+            Tuple of the deserialized figure and whether it is the one
+            requested; the figure is the slot's last good one, or None,
+            while the build runs or when too many builds are pending
+        """
+        value = self.cache.get(key)
+        if value is None:
+            with self._lock:
+                last = self.last_good.get(slot)
+                if last is not None and last[0] == key:
+                    value = last[1]
+        if value is None and self._executor is None:
+            value = self._build(key, slot, builder)
+        if value is not None:
+            return json.loads(value), True
+
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if len(self._pending) >= self.max_pending:
+                    # Full: no new build, and no wait for one
+                    last = self.last_good.get(slot)
+                    return (json.loads(last[1]) if last is not None else None), False
+                future = self._executor.submit(self._build, key, slot, builder)
+                self._pending[key] = future
+        try:
+            return json.loads(future.result(timeout)), True
+        except TimeoutError:
+            with self._lock:
+                last = self.last_good.get(slot)
+            return (json.loads(last[1]) if last is not None else None), False
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def clear(self):
+        # Forgets the last good figures; builds still running are kept
+        with self._lock:
+            self.last_good.clear()
+
+
+# Builds shared by the callbacks of this worker
+build_pool = BuildPool(figure_cache)
@@ -0,0 +1,327 @@
+# Figure cache
+#
+# Bounded, memory-aware LRU cache of serialized figure JSON. Keys are tuples
+# such as ("polar", row, data_version) so a new dataset never serves stale
+# figures. One instance is shared by all the callbacks of a worker.
+#
+# Behind it sits a second tier shared by every worker of the box: a
+# directory of JSON files (FIGURE_CACHE_DIR), namespaced by the code and
+# dataset versions, bounded in size and evicted least recently used first.
+# A figure built by one worker is then a warm hit for all the others, and
+# survives restarts. The namespaces also change with the settings that
+# change what is rendered, so a restart with new settings starts afresh.
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from plotly.utils import PlotlyJSONEncoder
+
+
+# Upper bound on the total size of the cached JSON, in bytes
+FIGURE_CACHE_BYTES = int(os.environ.get("FIGURE_CACHE_BYTES", 64 * 1024 * 1024))
+
+# Directory of the cache shared by the workers; empty to disable it
+FIGURE_CACHE_DIR = os.environ.get("FIGURE_CACHE_DIR",
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "figure-cache"))
+
+# Upper bound on the total size of the shared cache, in bytes
+FIGURE_CACHE_DIR_BYTES = int(os.environ.get("FIGURE_CACHE_DIR_BYTES", 512 * 1024 * 1024))
+
+# Environment variables changing the figures, the layout or the precomputed outputs
+RENDER_SETTINGS = ("TOP_FEATURES", "BOX_MAX_POINTS", "BUBBLE_MAX_POINTS", "BUBBLE_BINS",
+                   "PAIRWISE_MAX_POINTS", "PAIRWISE_MODE", "PAIRWISE_BINS", "NEIGHBOURS",
+                   "CLIENTSIDE_CALLBACKS")
+
+logger = logging.getLogger(__name__)
+
+
+def code_version(directory=os.path.dirname(os.path.abspath(__file__)), settings=RENDER_SETTINGS):
+    """
+    Function to derive a version string for the app's code and rendering settings
+
+    Arguments:
+        directory: directory of the app
+        settings: names of the environment variables changing what is rendered
+    Returns:
+        Hex digest of the Python modules, assets and settings, so neither a
+        deploy nor a restart with other settings serves what was rendered before
+    """
+    digest = hashlib.sha1()
+    for folder in (directory, os.path.join(directory, 'assets')):
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(('.py', '.js', '.css')):
+                with open(os.path.join(folder, name), 'rb') as f:
+                    digest.update(name.encode())
+                    digest.update(f.read())
+    for name in settings:
+        digest.update("{}={}\0".format(name, os.environ.get(name, "")).encode())
+    return digest.hexdigest()[:12]
+
+
+def private_directory(directory):
+    """
+    Function to create a directory only this user can write to, or check an existing one
+
+    Arguments:
+        directory: directory path
+    Returns:
+        True if the directory is owned by this user and not writable by
+        others, so files read from it were written by the app
+    """
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        stat = os.stat(directory)
+    except OSError:
+        return False
+    owner = os.getuid() if hasattr(os, 'getuid') else stat.st_uid
+    return stat.st_uid == owner and not stat.st_mode & 0o022
+
+
+CODE_VERSION = code_version()
+
+
+class DiskCache(object):
+    """
+    Cache of serialized figures in a directory shared by the workers
+
+    An entry is a file <directory>/<code version>-<data version>/<key hash>.json,
+    the data version being the last element of the key. Files are written
+    atomically, their modification time is bumped on every hit, and once
+    roughly an eighth of max_bytes has been written the oldest files are
+    deleted until the directory fits in max_bytes again. A directory that
+    other users could write to is never used.
+
+    Arguments:
+        directory: cache directory, created if missing
+        max_bytes: total size of the cached files before eviction
+    """
+
+    def __init__(self, directory, max_bytes=FIGURE_CACHE_DIR_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.written = 0
+        self._lock = threading.Lock()
+        self.usable = private_directory(directory)
+        if not self.usable:
+            logger.warning("Not using %s for the shared figure cache: it cannot be created, "
+                           "or is not owned by this user or is writable by others", directory)
+
+    def namespace(self, version):
+        return os.path.join(self.directory, "{}-{}".format(CODE_VERSION, version))
+
+    def path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest() + ".json"
+        return os.path.join(self.namespace(key[-1]), name)
+
+    def get(self, key):
+        """
+        Function to read the serialized figure for a key
+
+        Arguments:
+            key: tuple ending with the data version
+        Returns:
+            JSON string, or None on a miss
+        """
+        if not self.usable:
+            return None
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            # Missing, or evicted by another worker in between
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Function to write a serialized figure, evicting old files when needed
+
+        Arguments:
+            key: tuple ending with the data version
+            value: JSON string
+        Returns: None
+        """
+        if not self.usable or len(value) > self.max_bytes:
+            return
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            # The shared tier is best-effort, e.g. when the disk is full
+            return
+        with self._lock:
+            self.written += len(value)
+            evict = self.written > self.max_bytes // 8
+            if evict:
+                self.written = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Function to delete the least recently used files beyond max_bytes
+
+        Arguments: None
+        Returns: None
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            for item in os.scandir(entry.path):
+                if item.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = item.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def drop(self, version):
+        """
+        Function to delete the namespace of a data version
+
+        Arguments:
+            version: data version whose figures can no longer be served
+        Returns: None
+        """
+        shutil.rmtree(self.namespace(version), ignore_errors=True)
+
+
+class FigureCache(object):
+    """
+    LRU cache of serialized figures bounded by the total JSON size
+
+    Arguments:
+        max_bytes: total size of the cached JSON strings before eviction
+        backend: optional shared second tier with get and set, such as a
+            DiskCache, consulted on a miss and written through
+    """
+
+    def __init__(self, max_bytes=FIGURE_CACHE_BYTES, backend=None):
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Function to fetch the serialized figure for a key
+
+        Arguments:
+            key: hashable cache key
+        Returns:
+            JSON string, or None on a miss
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """
+        Function to store a serialized figure, evicting the least recently used ones
+
+        Arguments:
+            key: hashable cache key
+            value: JSON string
+        Returns: None
+        """
+        self._store(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def _store(self, key, value):
+        # Memory tier only
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def get_or_create(self, key, builder):
+        """
+        Function to return the cached figure or build and cache it
+
+        Arguments:
+            key: hashable cache key
+            builder: zero-argument function returning a figure or any JSON-able value
+        Returns:
+            Deserialized figure ready to be returned from a callback
+        """
+        value = self.get(key)
+        if value is None:
+            value = json.dumps(builder(), cls=PlotlyJSONEncoder)
+            self.set(key, value)
+        return json.loads(value)
+
+    def clear(self):
+        # Memory tier only; the shared tier is namespaced by version
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Function to report the cache counters
+
+        Arguments: None
+        Returns:
+            Dict with hits, misses, entries and bytes, and the hits served
+            by the shared tier
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self.current_bytes,
+                    'shared_hits': self.backend.hits if self.backend is not None else 0}
+
+
+# Cache shared by the callbacks of this worker, backed by the one shared by all workers
+figure_cache = FigureCache(backend=DiskCache(FIGURE_CACHE_DIR) if FIGURE_CACHE_DIR else None)
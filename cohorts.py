@@ -0,0 +1,126 @@
+# Cohort aggregates
+#
+# Tab 3 compares a record with the average of a reference population. By
+# default that is the record's class, whose means come from the class index;
+# a cohort instead selects the records whose value of any column of the
+# export lies in a range, e.g. "versicolor_prob from 0.8" or "petal length
+# (cm) from 4 to 5".
+#
+# For every column used as a filter, the rows are put in ascending order of
+# that column once and the prefix sums of the drawn SHAP values are taken in
+# that order. A range then resolves with two binary searches, its means are
+# a difference of two prefix sums, and the quantiles of the filter column
+# are read off the sorted values: O(log n) per cohort instead of a scan of
+# the rows. The prefix sums take 8 bytes per row and drawn feature, so only
+# those of the COHORT_INDEXES most recently used columns are kept, in an
+# LRU memoized on the dataset snapshot.
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from records import HALF_STEP, grid_bounds
+
+
+# Cohort columns whose sorted values and prefix sums are kept per worker
+COHORT_INDEXES = int(os.environ.get("COHORT_INDEXES", 4))
+
+_lock = threading.Lock()
+
+
+def cohort_columns(dataset):
+    # Every numeric column of the export can select a cohort
+    return [col for col in dataset.dfJoined.columns if col != 'target']
+
+
+def cohort_axes(dataset):
+    # Features drawn for some class, the only ones whose cohort means are needed
+    drawn = set(axis for entry in dataset.class_index.values() for axis in entry['top_axes'])
+    return [axis for axis in dataset.axes if axis in drawn]
+
+
+def prefix_sums(dataset, column):
+    """
+    Function to return the prefix sums of the drawn SHAP values in ascending order of a column
+
+    Arguments:
+        dataset: data snapshot
+        column: column of dfJoined
+    Returns:
+        Tuple of the drawn axes, the sorted values of the column and the
+        (rows + 1, axes) array of prefix sums, starting with a row of zeros
+    """
+    with _lock:
+        indexes = dataset.indexes.setdefault('cohorts', OrderedDict())
+        index = indexes.get(column)
+        if index is not None:
+            indexes.move_to_end(column)
+            return index
+    column_values = dataset.dfJoined[column].values
+    order = np.argsort(column_values, kind='mergesort')
+    axes = cohort_axes(dataset)
+    sums = np.zeros((len(order) + 1, len(axes)), dtype=np.float64)
+    np.cumsum(dataset.df[axes].values[order], axis=0, dtype=np.float64, out=sums[1:])
+    index = (axes, column_values[order], sums)
+    with _lock:
+        indexes[column] = index
+        while len(indexes) > COHORT_INDEXES:
+            indexes.popitem(last=False)
+    return index
+
+
+def cohort_bounds(values, low=None, high=None):
+    # Positions of the sorted values displayed within [low, high]; open ends when None
+    lo = 0 if low is None else np.searchsorted(values, grid_bounds(low)[1] - HALF_STEP, side='left')
+    hi = len(values) if high is None else np.searchsorted(values, grid_bounds(high)[0] + HALF_STEP, side='left')
+    return int(lo), int(max(lo, hi))
+
+
+def cohort_label(column, low=None, high=None):
+    if low is not None and high is not None:
+        return "{} from {:g} to {:g}".format(column, low, high)
+    if low is not None:
+        return "{} from {:g}".format(column, low)
+    if high is not None:
+        return "{} up to {:g}".format(column, high)
+    return "All records"
+
+
+def cohort_stats(dataset, column, low=None, high=None, quantiles=(0.25, 0.5, 0.75)):
+    """
+    Function to aggregate the records whose value of a column lies in a range
+
+    Arguments:
+        dataset: data snapshot
+        column: column of dfJoined selecting the cohort
+        low: lower bound of the displayed values, open when None
+        high: upper bound of the displayed values, open when None
+        quantiles: quantiles of the column to report
+    Returns:
+        Dict with the label, column, number of rows, rounded means and shifted
+        means of the drawn features and quantiles of the column, or None when the
+        column is unknown or the cohort empty
+    """
+    if column not in cohort_columns(dataset):
+        return None
+    axes, values, sums = prefix_sums(dataset, column)
+    lo, hi = cohort_bounds(values, low, high)
+    if hi == lo:
+        return None
+    mean = (sums[hi] - sums[lo]) / (hi - lo)
+    # Quantiles of the selected values, interpolated as numpy does
+    positions = lo + np.asarray(quantiles) * (hi - lo - 1)
+    below = np.floor(positions).astype(int)
+    above = np.minimum(below + 1, hi - 1)
+    # Only the few values needed are widened, not the column
+    lower, upper = values[below].astype(np.float64), values[above].astype(np.float64)
+    quantile_values = lower + (positions - below) * (upper - lower)
+    return {
+        'label': cohort_label(column, low, high),
+        'column': column,
+        'rows': hi - lo,
+        'mean': {axis: round(elem, 2) for axis, elem in zip(axes, mean.tolist())},
+        'norm_mean': {axis: round(elem, 2) for axis, elem in zip(axes, (mean + dataset.offset).tolist())},
+        'quantiles': dict(zip(quantiles, quantile_values.tolist())),
+    }
@@ -0,0 +1,250 @@
+# Columnar data format
+#
+# A SHAP export is stored as a directory holding
+#   <generation>.values.f32      - the float columns, each one a contiguous
+#                                  float32 segment of `capacity` rows
+#   <generation>.target.<dtype>  - the target column, in the smallest
+#                                  integer type holding every class
+#   meta.json                    - column names, target position and dtype,
+#                                  row count, capacity and generation
+# The blocks are memory-mapped read-only, so loading is near-instant and the
+# pages are shared by every process that maps the same files. A column is
+# read as one contiguous run of memory, not strided across the others.
+#
+# Appended rows fill the unused end of every segment; the blocks are created
+# at their full size as sparse files, so the spare capacity takes no disk.
+# When the segments are full, or a class outgrows the target dtype, the
+# writer moves to a new generation of blocks with twice the capacity, and a
+# fresh export always starts one. meta.json is switched over atomically and
+# the old blocks are then unlinked, never truncated, so a process that still
+# maps them keeps reading valid pages until it reloads.
+#
+# Converting the tab-separated export:
+#   python columnar.py shap.csv shap_data
+import argparse
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+VALUES_FILE = "{}.values.f32"
+TARGET_FILE = "{}.target.{}"
+META_FILE = "meta.json"
+TARGET_COLUMN = "target"
+# Rows per column segment of a new export; doubled whenever it fills up
+INITIAL_CAPACITY = 65536
+
+
+def is_columnar(path):
+    """
+    Function to tell whether a data path is a columnar directory
+
+    Arguments:
+        path: data path
+    Returns:
+        True if path holds a columnar export
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+def target_dtype(target):
+    # Smallest integer type holding every class
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if len(target) == 0 or (info.min <= target.min() and target.max() <= info.max):
+            return dtype
+    return np.int64
+
+
+def block_paths(path, generation, dtype):
+    # Paths of the float and target blocks of a generation
+    return (os.path.join(path, VALUES_FILE.format(generation)),
+            os.path.join(path, TARGET_FILE.format(generation, np.dtype(dtype).name)))
+
+
+def map_block(path, dtype, shape, mode='r'):
+    # np.memmap refuses empty files, which hold no rows anyway
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+
+class ColumnarWriter(object):
+    """
+    Writer appending DataFrame chunks to a columnar directory
+
+    Rows are appended to the blocks as they come, and meta.json is only
+    replaced (atomically) on close, so readers never see a partial chunk.
+    Blocks that readers may map are never truncated nor overwritten below
+    the committed row count.
+
+    Arguments:
+        path: output directory
+        columns: full column order, including the target column
+        append: keep the rows already in path instead of starting over
+    """
+
+    def __init__(self, path, columns=None, append=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if append and is_columnar(path):
+            meta = read_meta(path)
+            self.columns = meta['columns']
+            # Rows written after the last committed chunk are overwritten
+            self.rows = meta['rows']
+            self.capacity = meta['capacity']
+            self.generation = meta['generation']
+            self.target_dtype = np.dtype(meta['target_dtype'])
+        else:
+            if columns is None:
+                raise ValueError("columns are required for a new columnar export")
+            self.columns = list(columns)
+            self.rows = 0
+            # A fresh export never writes into the committed blocks
+            self.capacity = 0
+            self.generation = None
+            self.target_dtype = np.dtype(np.int8)
+        self.float_columns = [c for c in self.columns if c != TARGET_COLUMN]
+        self._values = self._target = None
+
+    def _open(self):
+        values_path, target_path = block_paths(self.path, self.generation, self.target_dtype)
+        self._values = map_block(values_path, np.float32, (len(self.float_columns), self.capacity), 'r+')
+        self._target = map_block(target_path, self.target_dtype, (self.capacity,), 'r+')
+
+    def _relayout(self, capacity, dtype):
+        # Copies the rows written so far to a new generation of blocks
+        if self._values is None and self.generation is not None:
+            self._open()
+        generation = uuid.uuid4().hex[:12]
+        for block, size in zip(block_paths(self.path, generation, dtype),
+                               (len(self.float_columns) * capacity * 4, capacity * np.dtype(dtype).itemsize)):
+            with open(block, 'wb') as f:
+                f.truncate(size)
+        old_values, old_target = self._values, self._target
+        self.capacity, self.generation, self.target_dtype = capacity, generation, np.dtype(dtype)
+        self._open()
+        if self.rows:
+            self._values[:, :self.rows] = old_values[:, :self.rows]
+            self._target[:self.rows] = old_target[:self.rows]
+
+    def append(self, frame):
+        """
+        Function to append a chunk of rows
+
+        Arguments:
+            frame: DataFrame holding at least the writer's columns
+        Returns: None
+        """
+        target = np.asarray(frame[TARGET_COLUMN].values)
+        if len(target) and not np.array_equal(target, np.round(target)):
+            raise ValueError("the {!r} column holds non-integer classes".format(TARGET_COLUMN))
+        dtype = np.promote_types(self.target_dtype, target_dtype(target))
+        end = self.rows + len(frame)
+        capacity = self.capacity
+        while capacity < end:
+            capacity = max(INITIAL_CAPACITY, 2 * capacity)
+        if self.generation is None or capacity != self.capacity or dtype != self.target_dtype:
+            self._relayout(capacity, dtype)
+        elif self._values is None:
+            self._open()
+        self._values[:, self.rows:end] = frame[self.float_columns].values.T
+        self._target[self.rows:end] = target
+        self.rows = end
+
+    def close(self):
+        """
+        Function to commit the appended rows by rewriting meta.json
+
+        Blocks of any other generation, including those of an abandoned
+        export, are unlinked once meta.json no longer names them.
+
+        Arguments: None
+        Returns: None
+        """
+        if self.generation is None:
+            self._relayout(0, self.target_dtype)
+        for block in (self._values, self._target):
+            if isinstance(block, np.memmap):
+                block.flush()
+        meta = {'columns': self.columns, 'target': TARGET_COLUMN, 'target_dtype': self.target_dtype.name,
+                'rows': self.rows, 'capacity': self.capacity, 'generation': self.generation}
+        tmp = os.path.join(self.path, META_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, META_FILE))
+        current = set(os.path.basename(block) for block in block_paths(self.path, self.generation, self.target_dtype))
+        for entry in os.listdir(self.path):
+            if entry not in current and entry.split(".")[1:2] in (["values"], ["target"]):
+                os.remove(os.path.join(self.path, entry))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_columnar(path):
+    """
+    Function to memory-map a columnar export as a DataFrame
+
+    The float segments become the single float32 block of the DataFrame
+    without being copied, one contiguous row of the block per column.
+
+    Arguments:
+        path: columnar directory
+    Returns:
+        DataFrame with the columns in their original order
+    """
+    meta = read_meta(path)
+    columns = meta['columns']
+    float_columns = [c for c in columns if c != meta['target']]
+    rows, capacity = meta['rows'], meta['capacity']
+
+    values_path, target_path = block_paths(path, meta['generation'], meta['target_dtype'])
+    values = map_block(values_path, np.float32, (len(float_columns), capacity))[:, :rows]
+    target = map_block(target_path, meta['target_dtype'], (capacity,))[:rows]
+
+    frame = pd.DataFrame(values.T, columns=float_columns, copy=False)
+    frame.insert(columns.index(meta['target']), meta['target'], target)
+    return frame
+
+
+def convert_tsv(tsv_path, out_path, chunksize=100000):
+    """
+    Function to convert a tab-separated SHAP export to the columnar format
+
+    Arguments:
+        tsv_path: tab-separated export written by shap.py
+        out_path: output directory
+        chunksize: rows parsed per chunk
+    Returns:
+        Number of rows written
+    """
+    writer = None
+    for chunk in pd.read_csv(tsv_path, sep='\t', chunksize=chunksize):
+        if writer is None:
+            writer = ColumnarWriter(out_path, chunk.columns)
+        writer.append(chunk)
+    if writer is None:
+        raise ValueError("{} holds no rows".format(tsv_path))
+    writer.close()
+    return writer.rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a tab-separated SHAP export to the columnar format")
+    parser.add_argument("tsv_path")
+    parser.add_argument("out_path")
+    parser.add_argument("--chunksize", type=int, default=100000)
+    args = parser.parse_args()
+    print("Wrote {} rows to {}".format(convert_tsv(args.tsv_path, args.out_path, args.chunksize), args.out_path))
@@ -0,0 +1,628 @@
+# Shared data layer
+#
+# The SHAP export (shap.csv, or a columnar directory written by columnar.py)
+# is loaded exactly once per process, here, into an immutable Dataset
+# snapshot that every other module reads through current(). With gunicorn's
+# --preload (see Procfile) the first load happens in the master before the
+# workers are forked, so all workers share the same pages copy-on-write.
+#
+# When the data file changes, the next call to current() after
+# DATA_RELOAD_INTERVAL seconds starts a background rebuild of the snapshot,
+# which is then swapped in atomically. If rows were only appended, just the
+# new rows are parsed and the class aggregates are updated incrementally.
+#
+# The frames hold the values as stored: float32 for every float column and
+# the smallest integer type for the target. Values are only rounded to
+# DISPLAY_DECIMALS when they are put into a figure or a table.
+#
+# Nothing here is specific to one model: the features are the columns with
+# a "_shap" suffix, the classes are the values of the target column, and
+# the charts of each class draw the TOP_FEATURES features with the largest
+# mean |SHAP| in that class.
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+from columnar import is_columnar, load_columnar, read_meta, target_dtype, META_FILE
+
+
+# Tab-separated export or columnar directory to serve
+DATA_PATH = os.environ.get("DATA_PATH", "shap.csv")
+
+# Seconds between checks for a new data file; 0 disables hot-reloading
+DATA_RELOAD_INTERVAL = float(os.environ.get("DATA_RELOAD_INTERVAL", 5))
+
+# Bytes at the end of a TSV compared to tell an append from a rewrite
+TAIL_BYTES = 4096
+
+# Features drawn per class, ranked by mean |SHAP| in the class
+TOP_FEATURES = int(os.environ.get("TOP_FEATURES", 8))
+
+SHAP_SUFFIX = "_shap"
+PROB_SUFFIX = "_prob"
+
+# Decimals of every value shown in a chart or the record table
+DISPLAY_DECIMALS = 2
+
+logger = logging.getLogger(__name__)
+
+
+def dataset_version(path=DATA_PATH):
+    """
+    Function to derive a short version string for the data file
+
+    Arguments:
+        path: path of the SHAP export
+    Returns:
+        Hex digest of the file name, size and modification time
+    """
+    # A columnar export is committed by rewriting its meta.json
+    stat = os.stat(os.path.join(path, META_FILE) if is_columnar(path) else path)
+    key = "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def source_state(path):
+    """
+    Function to record what can be read of the data file
+
+    A TSV is only read up to its last complete line: a writer may be
+    half-way through the next one.
+
+    Arguments:
+        path: path of the SHAP export
+    Returns:
+        Dict used by read_raw and by read_appended_rows to detect appends
+    """
+    if is_columnar(path):
+        meta = read_meta(path)
+        return {'columns': meta['columns'], 'rows': meta['rows'], 'generation': meta['generation']}
+    with open(path, 'rb') as f:
+        header = f.readline()
+        size = complete_size(f)
+        start = max(len(header), size - TAIL_BYTES)
+        f.seek(start)
+        tail = f.read(size - start)
+    return {'header': header, 'size': size, 'tail': tail}
+
+
+def complete_size(f):
+    # Bytes up to the end of the last complete line of an open file
+    end = f.seek(0, os.SEEK_END)
+    while end > 0:
+        start = max(0, end - TAIL_BYTES)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+class BoundedReader(io.RawIOBase):
+    """
+    Binary file reader stopping after a number of bytes
+
+    Arguments:
+        f: open binary file, positioned at the start
+        size: bytes to read
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.f.readinto(memoryview(buffer)[:self.remaining]) if self.remaining > 0 else 0
+        self.remaining -= n
+        return n
+
+
+def rounded(values):
+    """
+    Function to round values for display
+
+    Arguments:
+        values: scalar or array, of any float type
+    Returns:
+        float64 array (0-d for a scalar) rounded to DISPLAY_DECIMALS
+    """
+    # Widened first so the rounded value is exact in the JSON
+    return np.round(np.asarray(values, dtype=np.float64), DISPLAY_DECIMALS)
+
+
+def tsv_dtypes(columns):
+    # Float columns are parsed straight to float32, the target as integers
+    return {col: np.float32 for col in columns if col != 'target'}
+
+
+def read_raw(path, state=None):
+    """
+    Function to read the SHAP export as it is stored
+
+    Arguments:
+        path: path of the tab-separated SHAP export or of a columnar directory
+        state: source state of the file, bounding what is read of a TSV;
+            recorded now when not given
+    Returns:
+        DataFrame with the original column names
+    """
+    if is_columnar(path):
+        return load_columnar(path)
+    state = state or source_state(path)
+    columns = pd.read_csv(io.BytesIO(state['header']), sep='\t').columns
+    with open(path, 'rb') as f:
+        return pd.read_csv(io.BufferedReader(BoundedReader(f, state['size'])), sep='\t',
+                           dtype=tsv_dtypes(columns))
+
+
+def read_appended_rows(dataset):
+    """
+    Function to read only the rows appended to the data file since a snapshot
+
+    Arguments:
+        dataset: snapshot whose source state is compared with the file
+    Returns:
+        Tuple of the appended raw rows and the new source state, or None if
+        the file was rewritten rather than appended to
+    """
+    path, state = dataset.path, dataset.source_state
+    if is_columnar(path):
+        meta = read_meta(path)
+        # A rewrite always starts a new generation of blocks
+        if 'rows' not in state or meta['generation'] != state['generation'] or meta['rows'] < state['rows']:
+            return None
+        raw = load_columnar(path).iloc[state['rows']:].reset_index(drop=True)
+        return raw, {'columns': meta['columns'], 'rows': meta['rows'], 'generation': meta['generation']}
+
+    if 'header' not in state:
+        return None
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if header != state['header']:
+            return None
+        f.seek(0, os.SEEK_END)
+        if f.tell() < state['size']:
+            return None
+        f.seek(state['size'] - len(state['tail']))
+        if f.read(len(state['tail'])) != state['tail']:
+            return None
+        rest = f.read()
+
+    # A writer may be half-way through a line; it is picked up next time
+    rest = rest[:rest.rfind(b'\n') + 1]
+    names = header.decode().rstrip('\r\n').split('\t')
+    if rest:
+        raw = pd.read_csv(io.BytesIO(rest), sep='\t', header=None, names=names, dtype=tsv_dtypes(names))
+    else:
+        raw = pd.DataFrame(columns=names)
+    new_state = {'header': header, 'size': state['size'] + len(rest),
+                 'tail': (state['tail'] + rest)[-TAIL_BYTES:]}
+    return raw, new_state
+
+
+def infer_schema(columns):
+    """
+    Function to infer the features and their display names from the export's columns
+
+    Arguments:
+        columns: column names of the raw export
+    Returns:
+        Dict with the SHAP columns, the display names used as axes and
+        the probability columns
+    """
+    shap_columns = [col for col in columns if col.endswith(SHAP_SUFFIX)]
+    if not shap_columns:
+        raise ValueError("no column ends with {!r}".format(SHAP_SUFFIX))
+    # Features are named without their unit, e.g. "sepal length (cm)_shap"
+    # becomes "sepal length", unless that clashes with another column
+    axes = [re.sub(r'\s*\([^)]*\)$', '', col[:-len(SHAP_SUFFIX)]) for col in shap_columns]
+    if len(set(axes)) < len(axes) or set(axes) & (set(columns) - set(shap_columns)):
+        axes = list(shap_columns)
+    return {'shap_columns': shap_columns, 'axes': axes,
+            'prob_columns': [col for col in columns if col.endswith(PROB_SUFFIX)]}
+
+
+def prepare_frames(raw, schema=None):
+    """
+    Function to build the frames of a raw SHAP export in a single pass
+
+    The float columns are used as they are stored, already float32, with
+    the SHAP columns renamed to their display names; a memory-mapped
+    columnar export stays memory-mapped. Nothing is rounded.
+
+    Arguments:
+        raw: raw DataFrame as read from the export
+        schema: schema of the export, inferred when not given
+    Returns:
+        dfJoined and df DataFrames; df is the same frame as dfJoined, as
+        selecting the SHAP columns into a frame of their own would copy them
+    """
+    schema = schema or infer_schema(raw.columns)
+    # Renaming the SHAP columns to their display names for ease of reading
+    mapping = dict(zip(schema['shap_columns'], schema['axes']))
+    # Shallow: the renamed frame shares the raw frame's arrays
+    dfJoined = raw.rename(columns=mapping, copy=False)
+    for col in dfJoined.columns:
+        if col != 'target' and dfJoined[col].dtype != np.float32:
+            dfJoined[col] = dfJoined[col].astype(np.float32)
+    target = raw['target'].to_numpy()
+    if target.dtype != target_dtype(target):
+        position = list(dfJoined.columns).index('target')
+        del dfJoined['target']
+        dfJoined.insert(position, 'target', target.astype(target_dtype(target)))
+    return dfJoined, dfJoined
+
+
+def normalize(df, axes):
+    """
+    Function to find the offset shifting the SHAP values into the positive range
+
+    The shifted values are never stored; they are derived as df + offset
+    where they are drawn.
+
+    Arguments:
+        df: SHAP values frame
+        axes: display names of the SHAP columns
+    Returns:
+        Offset to add to the values
+    """
+    # Column by column, so the columns are not copied into one block first
+    return max(abs(float(df[col].min())) for col in axes + ["shift", "target"])
+
+
+def load_frames(path=DATA_PATH):
+    """
+    Function to read the SHAP export and build the derived frames
+
+    Arguments:
+        path: path of the tab-separated SHAP export or of a columnar directory
+    Returns:
+        dfJoined and df DataFrames and the offset of the SHAP values
+    """
+    raw = read_raw(path)
+    schema = infer_schema(raw.columns)
+    dfJoined, df = prepare_frames(raw, schema)
+    return dfJoined, df, normalize(df, schema['axes'])
+
+
+def build_target_options(classes, schema):
+    """
+    Function to build the dropdown options for the classes
+
+    Arguments:
+        classes: sorted class values found in the target column
+        schema: schema of the export
+    Returns:
+        List of label/value dicts
+    """
+    target_options = []
+
+    # A binary model exporting a single "<name>_prob" column is labelled
+    # after it, e.g. "Class Versicolor" and "Class Not Versicolor"
+    if set(classes) <= {0, 1} and len(schema['prob_columns']) == 1:
+        name = schema['prob_columns'][0][:-len(PROB_SUFFIX)].capitalize()
+        names = {0: 'Class Not ' + name, 1: 'Class ' + name}
+    else:
+        names = {}
+    for cls in classes:
+        target_options.append({'label': names.get(cls, 'Class {}'.format(cls)), 'value': cls})
+    return target_options
+
+
+def top_features(abs_mean, k=TOP_FEATURES):
+    # Positions of the k largest mean |SHAP| values, kept in column order
+    return sorted(np.argsort(-abs_mean, kind='mergesort')[:k].tolist())
+
+
+def column_blocks(df, axes):
+    # Views of the SHAP columns shared by all the class entries; nothing is copied
+    return {'axes': axes, 'shap': [df[axis].values for axis in axes]}
+
+
+def gather(blocks, rows, features=None):
+    # (rows, features) float32 array of the SHAP values of some rows, every feature when None
+    features = range(len(blocks['axes'])) if features is None else features
+    return np.column_stack([blocks['shap'][i][rows] for i in features])
+
+
+def box_stats(values, axes):
+    """
+    Function to compute the box-plot statistics of several features in one pass
+
+    Fences are the most extreme values within 1.5 IQR of the quartiles,
+    as Plotly draws them; the values beyond are the outliers.
+
+    Arguments:
+        values: (rows, features) array of the values drawn
+        axes: names of the features
+    Returns:
+        Dict keyed by feature with q1, median, q3, lowerfence, upperfence
+        and the array of outliers
+    """
+    q1, median, q3 = np.percentile(values, [25, 50, 75], axis=0)
+    reach = 1.5 * (q3 - q1)
+    inside = (values >= q1 - reach) & (values <= q3 + reach)
+    lowerfence = np.where(inside, values, np.inf).min(axis=0)
+    upperfence = np.where(inside, values, -np.inf).max(axis=0)
+    return {axis: {'q1': float(q1[i]), 'median': float(median[i]), 'q3': float(q3[i]),
+                   'lowerfence': float(lowerfence[i]), 'upperfence': float(upperfence[i]),
+                   'outliers': values[~inside[:, i], i]}
+            for i, axis in enumerate(axes)}
+
+
+def class_entry(blocks, rows, offset, shap_sum=None, abs_sum=None):
+    """
+    Function to build the aggregates of one class
+
+    Arguments:
+        blocks: arrays returned by column_blocks
+        rows: row positions of the class
+        offset: offset of the SHAP values, see normalize
+        shap_sum: running sum of the class's SHAP values when updating
+            incrementally; the means are then derived from it
+        abs_sum: running sum of the class's absolute SHAP values, used with shap_sum
+    Returns:
+        Dict with the row positions, sums, rounded means of every feature,
+        the class's top features and their box-plot statistics; the values
+        drawn are read from the frame through the row positions
+    """
+    if shap_sum is None:
+        class_values = gather(blocks, rows)
+        shap_sum = class_values.sum(axis=0, dtype=np.float64)
+        abs_sum = np.abs(class_values).sum(axis=0, dtype=np.float64)
+    mean = shap_sum / len(rows)
+    norm_mean = mean + offset
+    top = top_features(abs_sum / len(rows))
+    top_axes = [blocks['axes'][i] for i in top]
+    # Only the top features of the class are ever drawn, as displayed
+    top_values = rounded(gather(blocks, rows, top).astype(np.float64))
+    return {
+        'rows': rows,
+        'sum': shap_sum,
+        'abs_sum': abs_sum,
+        'mean': [round(elem, 2) for elem in mean.tolist()],
+        'norm_mean': [round(elem, 2) for elem in norm_mean.tolist()],
+        'top': top,
+        'top_axes': top_axes,
+        'box': box_stats(top_values, top_axes),
+    }
+
+
+def build_class_index(df, offset, axes):
+    """
+    Function to precompute the per-class aggregates used by the callbacks
+
+    Every callback that used to filter the frames by target and average the
+    result now does a dict lookup into this index instead.
+
+    Arguments:
+        df: SHAP values frame
+        offset: offset of the SHAP values, see normalize
+        axes: display names of the SHAP columns
+    Returns:
+        Dict keyed by class with the aggregates built by class_entry
+    """
+    blocks = column_blocks(df, axes)
+    return {int(cls): class_entry(blocks, rows, offset)
+            for cls, rows in df.groupby('target').indices.items()}
+
+
+def update_class_index(class_index, df, axes, start, offset, old_offset):
+    """
+    Function to update the class index after rows were appended
+
+    Classes without new rows are kept as they are unless the offset of
+    the SHAP values moved. The means of the others are updated from their running
+    sums; their box-plot statistics are rebuilt from their rows.
+
+    Arguments:
+        class_index: index of the snapshot before the append
+        df: SHAP values frame including the appended rows
+        axes: display names of the SHAP columns
+        start: position of the first appended row
+        offset: offset of the SHAP values including the appended rows
+        old_offset: offset before the append
+    Returns:
+        New class index
+    """
+    blocks = column_blocks(df, axes)
+    new_targets = df['target'].values[start:]
+    new_rows = {int(cls): rows + start
+                for cls, rows in pd.Series(new_targets).groupby(new_targets).indices.items()}
+    updated = {}
+    for cls in set(class_index) | set(new_rows):
+        old = class_index.get(cls)
+        added = new_rows.get(cls)
+        if added is None and offset == old_offset:
+            updated[cls] = old
+        elif old is None:
+            updated[cls] = class_entry(blocks, added, offset)
+        elif added is None:
+            updated[cls] = class_entry(blocks, old['rows'], offset, old['sum'], old['abs_sum'])
+        else:
+            updated[cls] = class_entry(blocks, np.concatenate([old['rows'], added]), offset,
+                                       old['sum'] + gather(blocks, added).sum(axis=0, dtype=np.float64),
+                                       old['abs_sum'] + np.abs(gather(blocks, added)).sum(axis=0, dtype=np.float64))
+    return updated
+
+
+class Dataset(object):
+    """
+    Immutable snapshot of the loaded data and everything derived from it
+
+    Arguments:
+        path: path of the SHAP export
+        version: dataset version, part of every figure cache key
+        source_state: what has been read of the file, see source_state
+        schema: features and display names, see infer_schema
+        dfJoined, df: derived frames
+        offset: offset shifting the SHAP values into the positive range
+        class_index: per-class aggregates
+    """
+
+    def __init__(self, path, version, source_state, schema, dfJoined, df, offset, class_index):
+        self.path = path
+        self.version = version
+        self.source_state = source_state
+        self.schema = schema
+        self.axes = schema['axes']
+        self.dfJoined = dfJoined
+        self.df = df
+        self.offset = offset
+        self.class_index = class_index
+        self.target_options = build_target_options(sorted(class_index), schema)
+        self.labels = {option['value']: option['label'] for option in self.target_options}
+        # Features with the largest mean |SHAP| over all classes, for the
+        # charts that are not specific to one class
+        abs_sum = sum(entry['abs_sum'] for entry in class_index.values())
+        self.top_axes = [self.axes[i] for i in top_features(abs_sum / max(1, len(df)))]
+        # Lookup structures built lazily by other modules for this snapshot
+        self.indexes = {}
+
+    def extend(self, raw, version, state):
+        """
+        Function to build the snapshot that follows an append
+
+        Arguments:
+            raw: appended rows as read from the export
+            version: version of the data file after the append
+            state: source state after the append
+        Returns:
+            New Dataset
+        """
+        if len(raw) == 0:
+            return Dataset(self.path, version, state, self.schema, self.dfJoined, self.df,
+                           self.offset, self.class_index)
+        start = len(self.df)
+        joined_new, _ = prepare_frames(raw, self.schema)
+        dfJoined = df = pd.concat([self.dfJoined, joined_new], ignore_index=True)
+        offset = normalize(df, self.axes)
+        class_index = update_class_index(self.class_index, df, self.axes, start, offset, self.offset)
+        return Dataset(self.path, version, state, self.schema, dfJoined, df, offset, class_index)
+
+
+def load_dataset(path=DATA_PATH):
+    """
+    Function to load a snapshot of the SHAP export from scratch
+
+    Arguments:
+        path: path of the tab-separated SHAP export or of a columnar directory
+    Returns:
+        Dataset
+    """
+    # Retry if the file changed while it was being read
+    for _ in range(3):
+        version = dataset_version(path)
+        state = source_state(path)
+        raw = read_raw(path, state)
+        if dataset_version(path) == version:
+            break
+    schema = infer_schema(raw.columns)
+    dfJoined, df = prepare_frames(raw, schema)
+    offset = normalize(df, schema['axes'])
+    class_index = build_class_index(df, offset, schema['axes'])
+    return Dataset(path, version, state, schema, dfJoined, df, offset, class_index)
+
+
+_dataset = load_dataset(DATA_PATH)
+_reload_lock = threading.Lock()
+_reload_listeners = []
+_last_check = time.time()
+_building = False
+
+
+def add_reload_listener(listener):
+    """
+    Function to register a callable run after a new snapshot is swapped in
+
+    Arguments:
+        listener: function taking the old and the new Dataset
+    Returns: None
+    """
+    _reload_listeners.append(listener)
+
+
+def current():
+    """
+    Function to return the active snapshot, checking for a new data file
+
+    Callbacks should call this once and use the returned snapshot for the
+    whole request, so a swap never mixes two versions.
+
+    Arguments: None
+    Returns:
+        Dataset
+    """
+    check_for_update()
+    return _dataset
+
+
+def check_for_update():
+    """
+    Function to start a background rebuild if the data file has changed
+
+    Arguments: None
+    Returns: None
+    """
+    global _last_check, _building
+    if DATA_RELOAD_INTERVAL <= 0 or time.time() - _last_check < DATA_RELOAD_INTERVAL:
+        return
+    with _reload_lock:
+        if _building or time.time() - _last_check < DATA_RELOAD_INTERVAL:
+            return
+        _last_check = time.time()
+        try:
+            version = dataset_version(_dataset.path)
+        except OSError:
+            # The file is being replaced
+            return
+        if version == _dataset.version:
+            return
+        _building = True
+    threading.Thread(target=reload_dataset, args=(version,), daemon=True).start()
+
+
+def reload_dataset(version):
+    """
+    Function to build the snapshot for a new data file and swap it in
+
+    A snapshot without rows or with a non-finite offset is not swapped in:
+    the file is most likely being rewritten in place. The current snapshot
+    is kept and the file is read again at the next interval.
+
+    Arguments:
+        version: version of the new data file
+    Returns: None
+    """
+    global _dataset, _building
+    old = _dataset
+    try:
+        appended = read_appended_rows(old)
+        if appended is None:
+            new = load_dataset(old.path)
+        else:
+            new = old.extend(appended[0], version, appended[1])
+        if len(new.df) == 0 or not np.isfinite(new.offset):
+            logger.warning("Version %s of %s holds no usable rows, keeping version %s",
+                           new.version, old.path, old.version)
+            return
+        _dataset = new
+        logger.info("Swapped in dataset version %s (%d rows)", new.version, len(new.df))
+        for listener in _reload_listeners:
+            listener(old, new)
+    except Exception:
+        logger.exception("Reloading %s failed, keeping version %s", old.path, old.version)
+    finally:
+        _building = False
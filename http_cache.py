@@ -0,0 +1,159 @@
+# HTTP caching and compression
+#
+# Every callback response and the layout are a pure function of the code,
+# the dataset version and the request, so they get a strong ETag derived
+# from those three. A request whose If-None-Match matches is answered with
+# a 304 before anything is built; callback POSTs are safe reads, so they
+# are validated like the GET of the layout.
+#
+# Responses are gzip-compressed by Flask-Compress (1.4 has no brotli), and
+# the compressed bodies are kept in an LRU keyed by path and ETag: a
+# repeated callback is served straight from it, without running the
+# callback or compressing again. A gzip body is a different representation,
+# so its ETag carries a "-gzip" suffix.
+#
+# A view answering with a provisional response, such as a placeholder for a
+# figure still being built, calls skip_cache so it gets neither.
+import hashlib
+import os
+
+import flask
+from flask_compress import Compress
+
+from cache import CODE_VERSION, FigureCache
+from data import current, add_reload_listener
+
+
+GZIP_SUFFIX = "-gzip"
+
+# Upper bound on the total size of the cached compressed responses, in bytes
+COMPRESS_CACHE_BYTES = int(os.environ.get("COMPRESS_CACHE_BYTES", 32 * 1024 * 1024))
+
+# gzip level of the compressed responses
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+
+class CompressedCache(FigureCache):
+    """
+    LRU cache of compressed response bodies keyed by path and ETag
+
+    Responses without an ETag have no key and are never cached.
+
+    Arguments:
+        max_bytes: total size of the cached bodies before eviction
+    """
+
+    def get(self, key):
+        return None if key is None else FigureCache.get(self, key)
+
+    def set(self, key, value):
+        if key is not None:
+            FigureCache.set(self, key, value)
+
+
+# Compressed responses shared by the requests of this worker
+compressed_cache = CompressedCache(COMPRESS_CACHE_BYTES)
+
+
+def request_etag(kind, body=b''):
+    """
+    Function to derive the strong ETag of a deterministic response
+
+    Arguments:
+        kind: name of the view
+        body: request body the response depends on
+    Returns:
+        ETag value, without quotes
+    """
+    digest = hashlib.sha1()
+    for part in (CODE_VERSION, current().version, kind):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def compress_cache_key(response):
+    # Flask-Compress looks compressed bodies up by this key
+    etag, _ = response.get_etag()
+    return (flask.request.path, etag) if etag else None
+
+
+def skip_cache():
+    # The response of the current request depends on more than the request
+    flask.g.skip_http_cache = True
+
+
+def tag_encoding(response):
+    # Gives a gzip body its own strong ETag, once Flask-Compress has run
+    etag, weak = response.get_etag()
+    if etag and not weak and response.headers.get('Content-Encoding') == 'gzip' \
+            and not etag.endswith(GZIP_SUFFIX):
+        response.set_etag(etag + GZIP_SUFFIX)
+    return response
+
+
+def cached(kind, view, with_body):
+    """
+    Function to wrap a view with ETag validation and the compressed cache
+
+    Arguments:
+        kind: name of the view, part of the ETag
+        view: Flask view function
+        with_body: whether the response depends on the request body
+    Returns:
+        Wrapped view function
+    """
+    def cached_view(*args, **kwargs):
+        etag = request_etag(kind, flask.request.get_data() if with_body else b'')
+        matched = [tag for tag in (etag, etag + GZIP_SUFFIX) if tag in flask.request.if_none_match]
+        if matched:
+            response = flask.Response(status=304)
+            etag = matched[0]
+        else:
+            gzipped = None
+            if 'gzip' in flask.request.headers.get('Accept-Encoding', '').lower():
+                gzipped = compressed_cache.get((flask.request.path, etag))
+            if gzipped is None:
+                response = view(*args, **kwargs)
+            else:
+                response = flask.Response(gzipped, mimetype='application/json',
+                                          headers={'Content-Encoding': 'gzip'})
+        if flask.g.get('skip_http_cache'):
+            response.headers['Cache-Control'] = 'no-store'
+        elif response.status_code in (200, 304):
+            response.set_etag(etag)
+            # Browsers keep the response but revalidate it on every use
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    return cached_view
+
+
+def enable_http_cache(app):
+    """
+    Function to add compression, ETags and 304 handling to a Dash app
+
+    The app must be created with compress=False, Flask-Compress being set
+    up here with the compressed cache.
+
+    Arguments:
+        app: Dash app whose routes are registered
+    Returns: None
+    """
+    server = app.server
+    server.config['COMPRESS_LEVEL'] = COMPRESS_LEVEL
+    server.config['COMPRESS_CACHE_KEY'] = compress_cache_key
+    server.config['COMPRESS_CACHE_BACKEND'] = lambda: compressed_cache
+    # Handlers run in reverse order of registration, so this one sees the compressed response
+    server.after_request(tag_encoding)
+    Compress(server)
+
+    prefix = app.config.routes_pathname_prefix
+    for name, with_body in (('_dash-update-component', True), ('_dash-layout', False)):
+        endpoint = prefix + name
+        server.view_functions[endpoint] = cached(name, server.view_functions[endpoint], with_body)
+
+    # Bodies cached for a replaced dataset can never be served again
+    add_reload_listener(lambda old, new: compressed_cache.clear())
@@ -0,0 +1,269 @@
+# Callback metrics
+#
+# Wraps the single Flask view that serves every Dash callback
+# (/_dash-update-component) and records, per callback output:
+#   - a latency histogram
+#   - a histogram of the serialized response size
+#   - call, error and PreventUpdate counts
+# together with the figure cache counters. Everything is exposed in the
+# Prometheus text format on /metrics of the Flask server. Counters are kept
+# per process, so each gunicorn worker reports its own.
+#
+# With PROFILE_DIR set, a request carrying the "X-Profile: 1" header is
+# sampled by a stack sampler while it runs, and the stacks are written to
+# PROFILE_DIR in the collapsed format read by flamegraph tools.
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import flask
+from dash.exceptions import PreventUpdate
+
+from builds import build_pool
+from cache import figure_cache
+
+
+# Directory receiving per-request profiles; profiling is off when empty
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+# Seconds between two stack samples of a profiled request
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.001))
+
+PROFILE_HEADER = "X-Profile"
+METRICS_PATH = "/metrics"
+
+# Histogram bucket upper bounds, in seconds and bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram in the Prometheus layout
+
+    Arguments:
+        buckets: increasing upper bounds; +Inf is implied
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{{},le="{:g}"}} {}'.format(name, labels, bound, count))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, self.count))
+        lines.append('{}_sum{{{}}} {:.6f}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+
+class CallbackMetrics(object):
+    """
+    Per-output counters of the Dash callbacks of a worker
+
+    Arguments: None
+    """
+
+    def __init__(self):
+        self.latency = {}
+        self.size = {}
+        self.errors = Counter()
+        self.prevented = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, output, seconds, size=None, error=False, prevented=False):
+        """
+        Function to record one callback call
+
+        Arguments:
+            output: Dash output id of the callback
+            seconds: time spent serving the request
+            size: bytes of the response, None when nothing was returned
+            error: True if the callback raised
+            prevented: True if the callback raised PreventUpdate
+        Returns: None
+        """
+        with self._lock:
+            if output not in self.latency:
+                self.latency[output] = Histogram(LATENCY_BUCKETS)
+                self.size[output] = Histogram(SIZE_BUCKETS)
+            self.latency[output].observe(seconds)
+            if size is not None:
+                self.size[output].observe(size)
+            if error:
+                self.errors[output] += 1
+            if prevented:
+                self.prevented[output] += 1
+
+    def render(self):
+        """
+        Function to render the counters in the Prometheus text format
+
+        Arguments: None
+        Returns:
+            Exposition text
+        """
+        lines = []
+        with self._lock:
+            outputs = sorted(self.latency)
+            lines.append('# HELP dash_callback_duration_seconds Time spent serving a callback')
+            lines.append('# TYPE dash_callback_duration_seconds histogram')
+            for output in outputs:
+                lines.extend(self.latency[output].render('dash_callback_duration_seconds', label(output)))
+            lines.append('# HELP dash_callback_response_bytes Size of the serialized callback response')
+            lines.append('# TYPE dash_callback_response_bytes histogram')
+            for output in outputs:
+                lines.extend(self.size[output].render('dash_callback_response_bytes', label(output)))
+            lines.append('# HELP dash_callback_errors_total Callbacks that raised an exception')
+            lines.append('# TYPE dash_callback_errors_total counter')
+            for output in outputs:
+                lines.append('dash_callback_errors_total{{{}}} {}'.format(label(output), self.errors[output]))
+            lines.append('# HELP dash_callback_prevented_total Callbacks that raised PreventUpdate')
+            lines.append('# TYPE dash_callback_prevented_total counter')
+            for output in outputs:
+                lines.append('dash_callback_prevented_total{{{}}} {}'.format(label(output), self.prevented[output]))
+
+        stats = figure_cache.stats()
+        lines.append('# HELP dash_figure_cache_hits_total Figures served from the cache')
+        lines.append('# TYPE dash_figure_cache_hits_total counter')
+        lines.append('dash_figure_cache_hits_total {}'.format(stats['hits']))
+        lines.append('# HELP dash_figure_cache_shared_hits_total Figures served from the cache shared by the workers')
+        lines.append('# TYPE dash_figure_cache_shared_hits_total counter')
+        lines.append('dash_figure_cache_shared_hits_total {}'.format(stats['shared_hits']))
+        lines.append('# HELP dash_figure_cache_misses_total Figures built on a cache miss')
+        lines.append('# TYPE dash_figure_cache_misses_total counter')
+        lines.append('dash_figure_cache_misses_total {}'.format(stats['misses']))
+        lines.append('# HELP dash_figure_cache_entries Figures held in the cache')
+        lines.append('# TYPE dash_figure_cache_entries gauge')
+        lines.append('dash_figure_cache_entries {}'.format(stats['entries']))
+        lines.append('# HELP dash_figure_cache_bytes Size of the cached figure JSON')
+        lines.append('# TYPE dash_figure_cache_bytes gauge')
+        lines.append('dash_figure_cache_bytes {}'.format(stats['bytes']))
+        lines.append('# HELP dash_figure_builds_pending Figures being built in the background')
+        lines.append('# TYPE dash_figure_builds_pending gauge')
+        lines.append('dash_figure_builds_pending {}'.format(build_pool.pending()))
+        return '\n'.join(lines) + '\n'
+
+
+def label(output):
+    escaped = output.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return 'output="{}"'.format(escaped)
+
+
+class StackSampler(object):
+    """
+    Sampling profiler of one thread, counting its collapsed stacks
+
+    Arguments:
+        thread_id: ident of the thread to sample
+        interval: seconds between two samples
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+def write_profile(output, stacks):
+    """
+    Function to write the sampled stacks of a request in the collapsed format
+
+    Arguments:
+        output: Dash output id of the profiled callback
+        stacks: Counter of collapsed stacks
+    Returns:
+        Path of the profile
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = "{}-{}.folded".format(re.sub(r'[^A-Za-z0-9_-]+', '_', output).strip('_'),
+                                 int(time.time() * 1000))
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write("{} {}\n".format(stack, count))
+    return path
+
+
+# Counters shared by the callbacks of this worker
+callback_metrics = CallbackMetrics()
+
+
+def instrument(app):
+    """
+    Function to wrap the callback view of a Dash app and add the /metrics route
+
+    Arguments:
+        app: Dash app whose routes are registered
+    Returns: None
+    """
+    endpoint = app.config.routes_pathname_prefix + '_dash-update-component'
+    dispatch = app.server.view_functions[endpoint]
+
+    def timed_dispatch():
+        body = flask.request.get_json(silent=True) or {}
+        output = str(body.get('output', ''))
+        sampler = None
+        if PROFILE_DIR and flask.request.headers.get(PROFILE_HEADER) == '1':
+            sampler = StackSampler(threading.get_ident()).start()
+        start = time.perf_counter()
+        try:
+            response = dispatch()
+        except PreventUpdate:
+            callback_metrics.record(output, time.perf_counter() - start, prevented=True)
+            raise
+        except Exception:
+            callback_metrics.record(output, time.perf_counter() - start, error=True)
+            raise
+        finally:
+            if sampler is not None:
+                logger.info("Wrote profile of %s to %s", output, write_profile(output, sampler.stop()))
+        # Sizes are of the JSON; bodies served compressed from the HTTP cache and 304s are not counted
+        size = None
+        if response.status_code == 200 and 'Content-Encoding' not in response.headers:
+            size = response.calculate_content_length()
+        callback_metrics.record(output, time.perf_counter() - start, size=size)
+        return response
+
+    app.server.view_functions[endpoint] = timed_dispatch
+    app.server.add_url_rule(METRICS_PATH, 'metrics', lambda: flask.Response(
+        callback_metrics.render(), mimetype='text/plain; version=0.0.4'))
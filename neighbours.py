@@ -0,0 +1,79 @@
+# Nearest neighbours in SHAP space
+#
+# Records whose SHAP vectors are close were explained the same way by the
+# model. A KD-tree over the SHAP values of the top features (those with the
+# largest mean |SHAP| over all classes, at most TOP_FEATURES) is built the
+# first time neighbours are asked for, memoized on the dataset snapshot, and
+# answers the k nearest records of any number of rows in one vectorized
+# query. A KD-tree is no faster than a brute-force scan beyond a dozen or so
+# dimensions, so the features that barely move the model's output are left
+# out of the distance rather than making every query a scan.
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from records import table_records
+
+
+# Nearest records listed next to the selected one in Tab 3
+NEIGHBOURS = int(os.environ.get("NEIGHBOURS", 5))
+
+
+def shap_tree(dataset):
+    """
+    Function to return the KD-tree of the SHAP vectors of a snapshot
+
+    Arguments:
+        dataset: data snapshot
+    Returns:
+        cKDTree over the rows of df, one dimension per top feature
+    """
+    tree = dataset.indexes.get('shap_tree')
+    if tree is None:
+        tree = cKDTree(dataset.df[dataset.top_axes].values.astype(np.float64))
+        dataset.indexes['shap_tree'] = tree
+    return tree
+
+
+def nearest_rows(dataset, rows, k=NEIGHBOURS):
+    """
+    Function to find the nearest records of several rows in a single query
+
+    Arguments:
+        dataset: data snapshot
+        rows: row positions to find the neighbours of
+        k: neighbours per row, the row itself excluded
+    Returns:
+        Tuple of two (len(rows), k) arrays, the neighbours' positions and
+        their Euclidean distances, nearest first. Missing neighbours of a
+        dataset with k rows or fewer have the position len(df) and an
+        infinite distance
+    """
+    rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+    tree = shap_tree(dataset)
+    distances, neighbours = tree.query(tree.data[rows], k=k + 1)
+    distances, neighbours = distances.reshape(len(rows), k + 1), neighbours.reshape(len(rows), k + 1)
+    # The row itself is dropped, wherever ties with identical vectors put it
+    keep = neighbours != rows[:, None]
+    keep[keep.sum(axis=1) > k, -1] = False
+    return neighbours[keep].reshape(len(rows), k), distances[keep].reshape(len(rows), k)
+
+
+def neighbour_records(dataset, row, k=NEIGHBOURS):
+    """
+    Function to build the records of the neighbour table of a row
+
+    Arguments:
+        dataset: data snapshot
+        row: selected row
+        k: number of neighbours
+    Returns:
+        List of records with the record number, distance and record columns
+    """
+    neighbours, distances = nearest_rows(dataset, [row], k)
+    found = neighbours[0] < len(dataset.df)
+    records = table_records(dataset, neighbours[0][found])
+    for record, distance in zip(records, distances[0][found].tolist()):
+        record['distance'] = round(distance, 2)
+    return records
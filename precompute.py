@@ -0,0 +1,199 @@
+# Precomputed figures
+#
+# The inputs of the Tab 1 and Tab 3 callbacks are finite: one value of the
+# class picker per class and one value of the row picker per row. This
+# module renders the outputs for all of them ahead of time, on a process
+# pool, into an artifact directory per code and dataset version:
+#   rows.bin     - the JSON of every row's outputs (polar, gauge, class
+#                  label), each zlib-compressed against a shared dictionary
+#   rows.idx.npy - offsets of the rows in rows.bin
+#   rows.zdict   - the dictionary, the outputs of the first row
+#   classes.json - the JSON of every class's box plot and bubble chart
+# The app memory-maps the artifacts and serves them without any Plotly work,
+# and renders live whatever is missing (another dataset version, no run).
+#
+#   python precompute.py --processes 4
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import zlib
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+from cache import CODE_VERSION
+from data import current
+from utils import create_box, create_bubble, create_row_outputs
+
+
+# Directory holding one artifact directory per code and dataset version
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", "artifacts")
+
+ROWS_FILE = "rows.bin"
+INDEX_FILE = "rows.idx.npy"
+ZDICT_FILE = "rows.zdict"
+CLASSES_FILE = "classes.json"
+
+
+def artifact_path(dataset, directory=ARTIFACT_DIR):
+    return os.path.join(directory, "{}-{}".format(CODE_VERSION, dataset.version))
+
+
+class ArtifactStore(object):
+    """
+    Read-only view of the precomputed outputs of one dataset version
+
+    Arguments:
+        path: artifact directory written by precompute
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, INDEX_FILE), mmap_mode='r')
+        self.rows = np.memmap(os.path.join(path, ROWS_FILE), dtype=np.uint8, mode='r') \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(path, ZDICT_FILE), 'rb') as f:
+            self.zdict = f.read()
+        with open(os.path.join(path, CLASSES_FILE)) as f:
+            self.classes = json.load(f)
+
+    def row_outputs(self, row):
+        """
+        Function to read the precomputed outputs of a row
+
+        Arguments:
+            row: row position
+        Returns:
+            JSON string of the polar figure, gauge figure and class label,
+            or None if the row was not precomputed
+        """
+        if not 0 <= row < len(self.offsets) - 1:
+            return None
+        blob = self.rows[self.offsets[row]:self.offsets[row + 1]].tobytes()
+        decompressor = zlib.decompressobj(zdict=self.zdict)
+        return (decompressor.decompress(blob) + decompressor.flush()).decode()
+
+    def class_figures(self, target_class):
+        """
+        Function to read the precomputed figures of a class
+
+        Arguments:
+            target_class: class value
+        Returns:
+            JSON string of the box plot and bubble chart, or None
+        """
+        return self.classes.get(str(target_class))
+
+
+def open_store(dataset):
+    """
+    Function to open the artifacts of a dataset snapshot, if they were precomputed
+
+    Arguments:
+        dataset: data snapshot
+    Returns:
+        ArtifactStore, or None when there are no artifacts for its version
+    """
+    store = dataset.indexes.get('artifacts')
+    if store is None:
+        # A miss is not remembered: artifacts may be written while the app runs
+        path = artifact_path(dataset)
+        if os.path.exists(os.path.join(path, INDEX_FILE)):
+            store = ArtifactStore(path)
+            dataset.indexes['artifacts'] = store
+    return store
+
+
+def render_row(dataset, row):
+    return json.dumps(create_row_outputs(row, dataset), cls=PlotlyJSONEncoder).encode()
+
+
+# Compression dictionary of the rendering process, set by _init_render_worker
+_zdict = b''
+
+
+def _init_render_worker(zdict):
+    global _zdict
+    _zdict = zdict
+
+
+def _render_rows(bounds):
+    # Renders and compresses rows [start, stop) of the current dataset
+    dataset = current()
+    blobs = []
+    for row in range(*bounds):
+        compressor = zlib.compressobj(9, zdict=_zdict)
+        blobs.append(compressor.compress(render_row(dataset, row)) + compressor.flush())
+    return dataset.version, blobs
+
+
+def precompute(directory=ARTIFACT_DIR, processes=1, chunk_size=1000):
+    """
+    Function to render the outputs of every class and row of the current dataset
+
+    Arguments:
+        directory: directory receiving the artifact directory
+        processes: number of rendering processes
+        chunk_size: rows rendered per task
+    Returns:
+        Path of the artifact directory
+    """
+    dataset = current()
+    path = artifact_path(dataset, directory)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    classes = {str(cls): json.dumps([create_box(entry, dataset=dataset),
+                                           create_bubble(entry, dataset=dataset)], cls=PlotlyJSONEncoder)
+               for cls, entry in dataset.class_index.items()}
+    with open(os.path.join(tmp, CLASSES_FILE), 'w') as f:
+        json.dump(classes, f)
+
+    # Every row's outputs share the templates of the first one
+    n = len(dataset.df)
+    zdict = render_row(dataset, 0) if n else b''
+    with open(os.path.join(tmp, ZDICT_FILE), 'wb') as f:
+        f.write(zdict)
+
+    offsets = [0]
+    chunks = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+    with open(os.path.join(tmp, ROWS_FILE), 'wb') as f:
+        if processes > 1:
+            with multiprocessing.get_context("fork").Pool(processes, _init_render_worker, (zdict,)) as pool:
+                results = pool.imap(_render_rows, chunks)
+                write_blobs(f, results, offsets, dataset.version)
+        else:
+            _init_render_worker(zdict)
+            write_blobs(f, map(_render_rows, chunks), offsets, dataset.version)
+    np.save(os.path.join(tmp, INDEX_FILE), np.array(offsets, dtype=np.int64))
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return path
+
+
+def write_blobs(f, results, offsets, version):
+    # Appends the compressed rows in order and records where each one ends
+    for chunk_version, blobs in results:
+        if chunk_version != version:
+            raise RuntimeError("the data file changed while precomputing")
+        for blob in blobs:
+            f.write(blob)
+            offsets.append(offsets[-1] + len(blob))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute the class and row figures of the dataset at DATA_PATH")
+    parser.add_argument("--out", default=ARTIFACT_DIR, help="artifact directory (default ARTIFACT_DIR)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+    start = time.time()
+    path = precompute(args.out, args.processes, args.chunk_size)
+    size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    print("Wrote {} rows to {} ({:.1f} MB) in {:.1f}s".format(
+        len(current().df), path, size / 1e6, time.time() - start))
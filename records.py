@@ -0,0 +1,226 @@
+# Record browser
+#
+# Server-side paging, sorting and filtering for the Tab 3 record table.
+# Every column gets a sorted index (argsort) the first time it is sorted or
+# filtered on, memoized on the dataset snapshot. Range filters then resolve
+# to a slice of that index with a binary search, and only the rows of the
+# requested page are ever serialized.
+#
+# Filters compare the values as displayed, rounded to DISPLAY_DECIMALS, so
+# "{shift} eq 0.5" matches every row showing 0.5.
+import math
+
+import numpy as np
+
+from data import DISPLAY_DECIMALS, rounded
+
+
+# Columns shown in the record table after the top features, besides the record number
+RECORD_COLUMNS = ["shift", "target"]
+
+# Filter operators of the DataTable query language, in parsing order
+FILTER_OPERATORS = [('ge', '>='), ('le', '<='), ('lt', '<'), ('gt', '>'), ('ne', '!='), ('eq', '=')]
+
+# Half of the last displayed decimal: a value is displayed as v when it
+# lies in [v - HALF_STEP, v + HALF_STEP)
+HALF_STEP = 0.5 * 10 ** -DISPLAY_DECIMALS
+
+
+def record_columns(dataset):
+    columns = dataset.top_axes + RECORD_COLUMNS[:1] + dataset.schema['prob_columns'] + RECORD_COLUMNS[1:]
+    return [col for col in columns if col in dataset.dfJoined.columns]
+
+
+def sorted_index(dataset, column):
+    """
+    Function to return the rows of a column in ascending order of value
+
+    Arguments:
+        dataset: data snapshot
+        column: column of dfJoined
+    Returns:
+        Tuple of the row positions and the sorted values
+    """
+    key = ('sorted', column)
+    index = dataset.indexes.get(key)
+    if index is None:
+        values = dataset.dfJoined[column].values
+        order = np.argsort(values, kind='mergesort')
+        index = (order, values[order])
+        dataset.indexes[key] = index
+    return index
+
+
+def grid_bounds(value):
+    """
+    Function to find the displayed values nearest to a value
+
+    Arguments:
+        value: value to compare with
+    Returns:
+        Tuple of the largest displayed value <= value and the smallest
+        displayed value >= value; both are value when it can be displayed
+    """
+    scale = 10 ** DISPLAY_DECIMALS
+    scaled = value * scale
+    # Tolerates the float error of values typed with DISPLAY_DECIMALS decimals
+    if abs(scaled - round(scaled)) < 1e-6:
+        return round(scaled) / scale, round(scaled) / scale
+    return math.floor(scaled) / scale, math.ceil(scaled) / scale
+
+
+def split_filter_part(filter_part):
+    """
+    Function to parse one clause of a DataTable filter query
+
+    Arguments:
+        filter_part: clause such as "{shift} ge 0.5"
+    Returns:
+        Tuple of column, operator and value, or (None, None, None)
+    """
+    for operator_type, symbol in FILTER_OPERATORS:
+        for operator in (operator_type, symbol):
+            if ' ' + operator + ' ' in filter_part:
+                name_part, value_part = filter_part.split(' ' + operator + ' ', 1)
+                name = name_part.strip()
+                if name.startswith('{') and name.endswith('}'):
+                    name = name[1:-1]
+                value = value_part.strip()
+                if value and value[0] == value[-1] and value[0] in ("'", '"', '`'):
+                    value = value[1:-1]
+                try:
+                    value = float(value)
+                except ValueError:
+                    return None, None, None
+                return name, operator_type, value
+    return None, None, None
+
+
+def filter_range(dataset, column, operator, value):
+    """
+    Function to resolve one filter clause with a binary search on the sorted index
+
+    The value is first moved to the nearest displayed value on the side the
+    operator selects, then widened to the range of stored values displayed
+    as it.
+
+    Arguments:
+        dataset: data snapshot
+        column: column to filter on
+        operator: one of ge, le, lt, gt, eq
+        value: value to compare with
+    Returns:
+        Row positions matching the clause, in ascending order of value
+    """
+    order, values = sorted_index(dataset, column)
+    below, above = grid_bounds(value)
+    step = 2 * HALF_STEP
+    lo, hi = 0, len(order)
+    if operator == 'eq' and below != above:
+        # No displayed value equals it
+        return order[:0]
+    if operator in ('ge', 'eq'):
+        lo = np.searchsorted(values, above - HALF_STEP, side='left')
+    if operator == 'gt':
+        lo = np.searchsorted(values, (above + step if below == above else above) - HALF_STEP, side='left')
+    if operator in ('le', 'eq'):
+        hi = np.searchsorted(values, below + HALF_STEP, side='left')
+    if operator == 'lt':
+        hi = np.searchsorted(values, (below - step if below == above else below) + HALF_STEP, side='left')
+    return order[lo:max(lo, hi)]
+
+
+def filter_rows(dataset, filter_query):
+    """
+    Function to find the rows matching a DataTable filter query
+
+    The narrowest range clause picks the candidate rows from its sorted
+    index; the other clauses are then checked on those candidates only.
+
+    Arguments:
+        dataset: data snapshot
+        filter_query: query such as "{shift} ge 0.5 && {target} eq 1"
+    Returns:
+        Sorted row positions, or None when nothing is filtered
+    """
+    columns = record_columns(dataset)
+    clauses = []
+    for part in (filter_query or '').split(' && '):
+        column, operator, value = split_filter_part(part)
+        if column in columns:
+            clauses.append((column, operator, value))
+    if not clauses:
+        return None
+
+    ranges = [(filter_range(dataset, *clause), clause) for clause in clauses if clause[1] != 'ne']
+    if ranges:
+        rows, first = min(ranges, key=lambda item: len(item[0]))
+        others = [clause for clause in clauses if clause is not first]
+    else:
+        rows, others = np.arange(len(dataset.dfJoined)), clauses
+
+    for column, operator, value in others:
+        values = rounded(dataset.dfJoined[column].values[rows])
+        keep = {'ge': values >= value, 'le': values <= value, 'lt': values < value,
+                'gt': values > value, 'eq': values == value, 'ne': values != value}[operator]
+        rows = rows[keep]
+    return np.sort(rows)
+
+
+def query_page(dataset, page_current, page_size, sort_by, filter_query):
+    """
+    Function to build one page of the record table
+
+    Arguments:
+        dataset: data snapshot
+        page_current: zero-based page number
+        page_size: rows per page
+        sort_by: DataTable sort_by list
+        filter_query: DataTable filter query
+    Returns:
+        Tuple of the page's records and the number of pages
+    """
+    rows = filter_rows(dataset, filter_query)
+    n = len(dataset.dfJoined) if rows is None else len(rows)
+
+    sort = [item for item in (sort_by or []) if item['column_id'] in record_columns(dataset)]
+    if sort:
+        order, _ = sorted_index(dataset, sort[0]['column_id'])
+        if rows is not None:
+            mask = np.zeros(len(dataset.dfJoined), dtype=bool)
+            mask[rows] = True
+            order = order[mask[order]]
+        if sort[0]['direction'] == 'desc':
+            order = order[::-1]
+    elif rows is not None:
+        order = rows
+    else:
+        order = None
+
+    start = page_current * page_size
+    if order is None:
+        page_rows = np.arange(start, min(start + page_size, n))
+    else:
+        page_rows = order[start:start + page_size]
+
+    page_count = max(1, -(-n // page_size))
+    return table_records(dataset, page_rows), page_count
+
+
+def table_records(dataset, rows):
+    """
+    Function to build the records of a table showing some rows as displayed
+
+    Arguments:
+        dataset: data snapshot
+        rows: row positions, in the order of the table
+    Returns:
+        List of records with the record number and the record columns
+    """
+    page = dataset.dfJoined.iloc[rows][record_columns(dataset)]
+    # Values are rounded for display only, the target is kept as an integer
+    page = page.assign(**{col: rounded(page[col].values) for col in page.columns if col != 'target'})
+    records = page.to_dict('records')
+    for record, row in zip(records, np.asarray(rows).tolist()):
+        record['record'] = row
+    return records
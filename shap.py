@@ -4,6 +4,9 @@
 # In[1]:
 
 
+import multiprocessing
+import os
+
 from sklearn.datasets import load_iris
 from sklearn.model_selection import train_test_split
 from xgboost import XGBClassifier
@@ -11,6 +14,8 @@ import numpy as np
 import pandas as pd
 import shap
 
+from columnar import ColumnarWriter
+
 
 # Training a Model
 # ================
@@ -30,6 +35,16 @@ data = load_iris()
 target = np.where(data["target"] == 1, data["target"], 0)
 data_train, data_test, target_train, target_test = train_test_split(data["data"], target, random_state=1000)
 
+# Rows explained and written at a time. Peak memory of the export below is
+# bounded by this rather than by the size of data_test.
+CHUNK_SIZE = 10000
+
+# Tab-separated file (*.csv) or columnar directory read by the dashboard
+OUTPUT_PATH = "shap.csv"
+
+# Processes sharing the SHAP computation of each chunk; 1 runs it serially
+SHAP_PROCESSES = int(os.environ.get("SHAP_PROCESSES", 1))
+
 
 # In[3]:
 
@@ -38,7 +53,8 @@ data_train, data_test, target_train, target_test = train_test_split(data["data"]
 
 model = XGBClassifier()
 model.fit(data_train, target_train)
-results = model.predict_proba(data_test)[:,1]
+data_preview = data_test[:CHUNK_SIZE]
+results = model.predict_proba(data_preview)[:,1]
 results
 
 
@@ -54,7 +70,7 @@ results
 # In[4]:
 
 
-margin = model.predict(data_test, output_margin=True)
+margin = model.predict(data_preview, output_margin=True)
 margin
 
 
@@ -63,7 +79,7 @@ margin
 
 # Summarize prediction Results
 
-dfResults = pd.DataFrame(data_test)
+dfResults = pd.DataFrame(data_preview)
 dfResults.columns = data["feature_names"]
 dfResults["versicolor_prob"] = results
 dfResults["versicolor_margin"] = margin
@@ -90,9 +106,14 @@ dfResults
 
 
 # Generate shap data
+#
+# Only the row shown by force_plot below is explained here; the export
+# computes the SHAP values of every row, chunk by chunk.
+
+PREVIEW_ROW = 9
 
 explainer = shap.TreeExplainer(model, data=data_train)
-shap_values = explainer.shap_values(data_test)
+shap_values = explainer.shap_values(data_test[PREVIEW_ROW:PREVIEW_ROW + 1])
 
 
 # In[7]:
@@ -114,14 +135,120 @@ explainer.expected_value
 
 
 # Combine everything into a formatted dataframe.
-
-dfShaps = pd.DataFrame(shap_values)
-dfShaps.columns = [i + "_shap" for i in data["feature_names"]]
-dfJoined = pd.merge(dfResults, dfShaps, left_index=True, right_index=True)
-dfJoined["shift"] = dfJoined["versicolor_margin"].apply(lambda x: x - explainer.expected_value)
-dfJoined["target"] = target_test
-dfJoined = dfJoined[["sepal length (cm)", "sepal length (cm)_shap", "sepal width (cm)", "sepal width (cm)_shap", "petal length (cm)", "petal length (cm)_shap", "petal width (cm)", "petal width (cm)_shap", "versicolor_margin", "shift", "versicolor_prob", "target"]]
-dfJoined
+#
+# The export is built chunk by chunk: each chunk's probabilities, margins
+# and SHAP values are computed, combined column by column and appended to
+# OUTPUT_PATH before the next chunk is explained.
+
+columns = ["sepal length (cm)", "sepal length (cm)_shap", "sepal width (cm)", "sepal width (cm)_shap", "petal length (cm)", "petal length (cm)_shap", "petal width (cm)", "petal width (cm)_shap", "versicolor_margin", "shift", "versicolor_prob", "target"]
+
+
+def iter_chunks(rows, targets, chunk_size=CHUNK_SIZE):
+    """
+    Function to slice the rows to explain into chunks
+
+    Arguments:
+        rows: feature matrix, any array supporting slicing (e.g. np.memmap)
+        targets: true classes of the rows
+        chunk_size: rows per chunk
+    Returns:
+        Generator of (rows, targets) chunks
+    """
+    for start in range(0, len(rows), chunk_size):
+        yield np.asarray(rows[start:start + chunk_size]), np.asarray(targets[start:start + chunk_size])
+
+
+# Explainer of a pool worker, built once by _init_shap_worker
+_worker_explainer = None
+
+
+def _init_shap_worker(worker_model, background):
+    global _worker_explainer
+    _worker_explainer = shap.TreeExplainer(worker_model, data=background)
+
+
+def _shap_shard(shard):
+    return _worker_explainer.shap_values(shard)
+
+
+def compute_shap_values(chunk_data, pool=None):
+    """
+    Function to compute the SHAP values of a chunk, optionally on a process pool
+
+    The chunk is split into contiguous shards, one per process, and the
+    results are concatenated in order. Each row's SHAP values only depend
+    on the model and background, so the output is identical to the serial
+    path.
+
+    Arguments:
+        chunk_data: feature matrix of the chunk
+        pool: pool created with _init_shap_worker, or None for the serial path
+    Returns:
+        Array of SHAP values with one row per input row
+    """
+    if pool is None:
+        return explainer.shap_values(chunk_data)
+    shards = np.array_split(chunk_data, min(SHAP_PROCESSES, len(chunk_data)))
+    return np.concatenate(pool.map(_shap_shard, shards))
+
+
+def explain_chunk(chunk_data, chunk_target, pool=None):
+    """
+    Function to build the dashboard columns for one chunk of rows
+
+    Arguments:
+        chunk_data: feature matrix of the chunk
+        chunk_target: true classes of the chunk
+        pool: optional process pool for the SHAP values
+    Returns:
+        DataFrame with the dashboard's columns
+    """
+    chunk_shap = compute_shap_values(chunk_data, pool)
+    chunk_margin = model.predict(chunk_data, output_margin=True)
+
+    frame = {}
+    for i, name in enumerate(data["feature_names"]):
+        frame[name] = chunk_data[:, i]
+        frame[name + "_shap"] = chunk_shap[:, i]
+    frame["versicolor_margin"] = chunk_margin
+    # Vectorized shift, in float64 like the expected value
+    frame["shift"] = chunk_margin.astype(np.float64) - explainer.expected_value
+    frame["versicolor_prob"] = model.predict_proba(chunk_data)[:, 1]
+    frame["target"] = chunk_target
+    return pd.DataFrame(frame, columns=columns)
+
+
+def write_export(chunks, path=OUTPUT_PATH):
+    """
+    Function to write explained chunks to the dashboard's data file
+
+    The dashboard may be serving path while the export runs, so it is never
+    written in place: a TSV is streamed to path + ".tmp" and moved over path
+    once complete, and a columnar export only switches its meta.json over to
+    the new blocks on close. A failed export leaves path as it was.
+
+    Arguments:
+        chunks: iterable of DataFrames built by explain_chunk
+        path: tab-separated file (*.csv) or columnar directory
+    Returns:
+        Number of rows written
+    """
+    rows = 0
+    writer = None
+    tmp = path + ".tmp"
+    for i, frame in enumerate(chunks):
+        if path.endswith(".csv"):
+            frame.to_csv(tmp, sep='\t', index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+        else:
+            if writer is None:
+                writer = ColumnarWriter(path, frame.columns)
+            writer.append(frame)
+        rows += len(frame)
+    if writer is not None:
+        writer.close()
+    elif os.path.exists(tmp):
+        os.replace(tmp, path)
+    return rows
 
 
 # Now let's take a look at row 9 and attempt to use SHAP to explain why it is not a versicolor.
@@ -136,5 +263,12 @@ dfJoined
 
 
 shap.initjs()
-shap.force_plot(explainer.expected_value, shap_values[9], data["feature_names"])
-dfJoined.to_csv("shap.csv", sep='\t', index = False)
+shap.force_plot(explainer.expected_value, shap_values[0], data["feature_names"])
+if SHAP_PROCESSES > 1:
+    # Workers are forked so they hold the model and background once each
+    with multiprocessing.get_context("fork").Pool(SHAP_PROCESSES, _init_shap_worker, (model, data_train)) as pool:
+        write_export(explain_chunk(chunk_data, chunk_target, pool)
+                     for chunk_data, chunk_target in iter_chunks(data_test, target_test))
+else:
+    write_export(explain_chunk(chunk_data, chunk_target)
+                 for chunk_data, chunk_target in iter_chunks(data_test, target_test))
@@ -0,0 +1,9 @@
+# The data module loads DATA_PATH on import, so the tests point it at the
+# shipped export and turn hot-reloading off before anything imports it
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATA_PATH", os.path.join(ROOT, "shap.csv"))
+os.environ["DATA_RELOAD_INTERVAL"] = "0"
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import cohorts
+import data
+import records
+
+
+OPERATORS = {'ge': np.greater_equal, 'le': np.less_equal, 'lt': np.less, 'gt': np.greater,
+             'eq': np.equal, 'ne': np.not_equal}
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return data.load_dataset(data.DATA_PATH)
+
+
+def displayed(dataset, column):
+    return data.rounded(dataset.dfJoined[column].values)
+
+
+def boundaries(dataset, column):
+    # Displayed values of the column, the ones a filter hits exactly, and values off the grid
+    values = np.unique(displayed(dataset, column))
+    return [values[0], values[len(values) // 2], values[-1], values[0] - 1, values[-1] + 1,
+            float(values[len(values) // 2]) + records.HALF_STEP / 2]
+
+
+def queried_rows(dataset, filter_query, sort_by=None):
+    page, _ = records.query_page(dataset, 0, len(dataset.dfJoined) + 1, sort_by, filter_query)
+    return [record['record'] for record in page]
+
+
+def test_filter_clauses_match_a_scan(dataset):
+    for column in records.record_columns(dataset):
+        values = displayed(dataset, column)
+        for value in boundaries(dataset, column):
+            for operator, compare in OPERATORS.items():
+                query = "{{{}}} {} {!r}".format(column, operator, float(value))
+                expected = np.nonzero(compare(values, value))[0].tolist()
+                assert queried_rows(dataset, query) == expected, query
+
+
+def test_combined_clauses_match_a_scan(dataset):
+    shift = displayed(dataset, 'shift')
+    low, high = np.quantile(shift, [0.25, 0.75])
+    low, high = float(data.rounded(low)), float(data.rounded(high))
+    cases = {
+        "{{shift}} ge {} && {{shift}} le {}".format(low, high): (shift >= low) & (shift <= high),
+        "{{shift}} gt {} && {{shift}} lt {}".format(low, high): (shift > low) & (shift < high),
+        "{{shift}} ge {} && {{shift}} ne {}".format(low, high): (shift >= low) & (shift != high),
+        # An inverted range selects nothing
+        "{{shift}} ge {} && {{shift}} le {}".format(high, low): np.zeros(len(shift), dtype=bool),
+        "{{shift}} ge {} && {{target}} eq 1".format(low): (shift >= low) & (dataset.dfJoined['target'].values == 1),
+    }
+    for query, mask in cases.items():
+        assert queried_rows(dataset, query) == np.nonzero(mask)[0].tolist(), query
+
+
+def test_sorted_pages_follow_the_displayed_order(dataset):
+    shift = displayed(dataset, 'shift')
+    rows = queried_rows(dataset, "{shift} ge 0", [{'column_id': 'shift', 'direction': 'asc'}])
+    assert sorted(rows) == np.nonzero(shift >= 0)[0].tolist()
+    assert np.all(np.diff(shift[rows]) >= 0)
+    rows = queried_rows(dataset, None, [{'column_id': 'shift', 'direction': 'desc'}])
+    assert np.all(np.diff(shift[rows]) <= 0)
+
+
+def test_cohorts_match_a_scan(dataset):
+    for column in ['shift', 'versicolor_prob', dataset.axes[0]]:
+        values = displayed(dataset, column)
+        grid = boundaries(dataset, column)
+        for low, high in [(grid[1], None), (None, grid[1]), (grid[0], grid[2]), (grid[5], grid[2]),
+                          (grid[0], grid[5]), (grid[1], grid[1])]:
+            mask = np.ones(len(values), dtype=bool)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+            stats = cohorts.cohort_stats(dataset, column, low, high)
+            assert stats['rows'] == mask.sum(), (column, low, high)
+            for axis, mean in stats['mean'].items():
+                assert mean == round(float(dataset.dfJoined[axis].values[mask].astype(np.float64).mean()), 2)
+            quantiles = np.quantile(dataset.dfJoined[column].values[mask].astype(np.float64), [0.25, 0.5, 0.75])
+            np.testing.assert_allclose(list(stats['quantiles'].values()), quantiles)
+
+
+def test_empty_cohorts_fall_back_to_the_class(dataset):
+    values = np.unique(displayed(dataset, 'shift'))
+    # An inverted range, a range past the values and an off-grid range between two of them
+    assert cohorts.cohort_stats(dataset, 'shift', values[-1], values[0]) is None
+    assert cohorts.cohort_stats(dataset, 'shift', values[-1] + 1) is None
+    between = float(values[0]) + records.HALF_STEP / 2
+    assert cohorts.cohort_stats(dataset, 'shift', between, between) is None
+    assert cohorts.cohort_stats(dataset, 'unknown', 0) is None
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data
+
+
+@pytest.fixture
+def lines():
+    # Header and rows of the shipped export
+    with open(data.DATA_PATH, 'rb') as f:
+        return f.read().splitlines(keepends=True)
+
+
+def write(path, content, mode='wb'):
+    with open(path, mode) as f:
+        f.write(content)
+
+
+def assert_same(dataset, expected):
+    pd.testing.assert_frame_equal(dataset.dfJoined, expected.dfJoined)
+    assert dataset.offset == expected.offset
+    assert sorted(dataset.class_index) == sorted(expected.class_index)
+    for cls, entry in expected.class_index.items():
+        np.testing.assert_array_equal(dataset.class_index[cls]['rows'], entry['rows'])
+        np.testing.assert_allclose(dataset.class_index[cls]['sum'], entry['sum'])
+        assert dataset.class_index[cls]['mean'] == entry['mean']
+        assert dataset.class_index[cls]['top_axes'] == entry['top_axes']
+
+
+def test_append_matches_full_load(tmp_path, lines):
+    path = str(tmp_path / "shap.csv")
+    write(path, b''.join(lines[:20]))
+    dataset = data.load_dataset(path)
+    write(path, b''.join(lines[20:]), 'ab')
+
+    appended = data.read_appended_rows(dataset)
+    assert appended is not None
+    extended = dataset.extend(appended[0], data.dataset_version(path), appended[1])
+
+    assert len(extended.df) == len(lines) - 1
+    assert_same(extended, data.load_dataset(path))
+
+
+def test_partial_last_line_is_left_for_the_next_reload(tmp_path, lines):
+    path = str(tmp_path / "shap.csv")
+    half = len(lines[20]) // 2
+    write(path, b''.join(lines[:20]) + lines[20][:half])
+    dataset = data.load_dataset(path)
+
+    # Only the complete lines are loaded and recorded as read
+    assert len(dataset.df) == 19
+    assert not dataset.dfJoined.isnull().values.any()
+    assert dataset.source_state['size'] == len(b''.join(lines[:20]))
+
+    write(path, lines[20][half:] + b''.join(lines[21:]), 'ab')
+    appended = data.read_appended_rows(dataset)
+    assert appended is not None
+    extended = dataset.extend(appended[0], data.dataset_version(path), appended[1])
+    assert_same(extended, data.load_dataset(path))
+
+
+def test_rewrite_is_not_an_append(tmp_path, lines):
+    path = str(tmp_path / "shap.csv")
+    write(path, b''.join(lines[:20]))
+    dataset = data.load_dataset(path)
+    write(path, lines[0] + b''.join(lines[30:]))
+    assert data.read_appended_rows(dataset) is None
+
+
+def test_empty_rewrite_is_not_swapped_in(tmp_path, lines, monkeypatch):
+    path = str(tmp_path / "shap.csv")
+    write(path, b''.join(lines[:20]))
+    dataset = data.load_dataset(path)
+    monkeypatch.setattr(data, '_dataset', dataset)
+
+    # What to_csv(mode='w') leaves until its first rows are flushed
+    write(path, lines[0])
+    data.reload_dataset(data.dataset_version(path))
+    assert data._dataset is dataset
+
+    write(path, b''.join(lines))
+    data.reload_dataset(data.dataset_version(path))
+    assert len(data._dataset.df) == len(lines) - 1
@@ -1,146 +1,293 @@
 # Importing libraries
+import json
+import math
+import os
+from functools import lru_cache
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
 import plotly.graph_objs as go
+import numpy as np
 import pandas as pd
 from plotly.subplots import make_subplots
+from plotly.colors import qualitative
+from plotly.utils import PlotlyJSONEncoder
 import dash_table
 
-# Reading data in as DataFrame
-dfJoined = pd.read_csv("shap.csv", sep='\t')
-# Copy selected columns
-df = dfJoined[["sepal length (cm)_shap", "sepal width (cm)_shap", "petal length (cm)_shap", "petal width (cm)_shap","shift","target"]]
+from data import current, rounded
 
-# Storing required column names
-axes =["sepal length", "sepal width", "petal length", "petal width"]
 
-# Renaming the column names for ease of reading
-mapping1 = {dfJoined.columns[1]:axes[0], dfJoined.columns[3]: axes[1], dfJoined.columns[5]:axes[2], dfJoined.columns[7]:axes[3]}
-mapping2 = {df.columns[0]:axes[0], df.columns[1]: axes[1], df.columns[2]:axes[2], df.columns[3]:axes[3]}
-dfJoined = dfJoined.rename(columns=mapping1)
-df=df.rename(columns=mapping2)
+# Rows drawn in the scatter matrix before sampling or binning kicks in
+PAIRWISE_MAX_POINTS = int(os.environ.get("PAIRWISE_MAX_POINTS", 20000))
+# Large-dataset mode of the scatter matrix, "sample" or "density"
+PAIRWISE_MODE = os.environ.get("PAIRWISE_MODE", "sample")
+# Bins per attribute in the density mode
+PAIRWISE_BINS = int(os.environ.get("PAIRWISE_BINS", 40))
 
-# Rounding of decimals to standardize
-df=df.round(decimals=2)
-dfJoined=dfJoined.round(decimals=2)
+# Feature colors, cycled when there are more features than colors
+PALETTE = ["#E4FF87", '#70DDFF', '#709BFF', '#FFAA70'] + qualitative.Plotly
 
-# Creating a new DF with shap values in the positive range
-df_norm=df+max(abs(df.min()))
-df_norm['shift'] = dfJoined['shift']
-df_norm['target'] = dfJoined['target']
+# Gauges per row of the gauge chart
+GAUGE_COLUMNS = 4
 
-target_options = []
+# Rows of a class drawn as points in the box plot; larger classes are drawn
+# from the statistics precomputed in the class index
+BOX_MAX_POINTS = int(os.environ.get("BOX_MAX_POINTS", 5000))
+
+# Rows of a class drawn as markers in the bubble chart; larger classes are
+# binned on a grid of BUBBLE_BINS x BUBBLE_BINS cells of shift and SHAP value
+BUBBLE_MAX_POINTS = int(os.environ.get("BUBBLE_MAX_POINTS", 5000))
+BUBBLE_BINS = int(os.environ.get("BUBBLE_BINS", 40))
 
-# Storing the class names based on class numbers 0 or 1
-for cls in range(0,2):
-    if cls == 0:
-        target_options.append({'label':'Class Not Versicolor','value':cls})
-    else:
-        target_options.append({'label':'Class Versicolor','value':cls})
 
+def palette(n):
+    return [PALETTE[i % len(PALETTE)] for i in range(n)]
 
-def create_polar(row):
+
+def display_ranges(dataset):
     """
-    Function to create the polar-bar chart_box
+    Function to return the axis ranges of the Tab 3 charts for a snapshot
+
+    The shifted values grow with the number of features, so the ranges are
+    taken from the values of the features drawn for some class, rounded up
+    to whole numbers, and memoized on the snapshot.
 
     Arguments:
-        row: Selected row
+        dataset: data snapshot
     Returns:
-        Figure object
+        Tuple of the radial maximum of the polar charts and the gauge limit
     """
-    #row=0
+    ranges = dataset.indexes.get('ranges')
+    if ranges is None:
+        df = dataset.df
+        drawn = set(axis for entry in dataset.class_index.values() for axis in entry['top_axes'])
+        lows = [float(df[axis].min()) for axis in drawn]
+        highs = [float(df[axis].max()) for axis in drawn]
+        ranges = (int(math.ceil(max(highs) + dataset.offset)),
+                  int(math.ceil(max(max(highs), -min(lows)))))
+        dataset.indexes['ranges'] = ranges
+    return ranges
+
+
+@lru_cache(maxsize=None)
+def build_polar_template(axes, radial_max):
+    """
+    Function to build the polar-bar figure once per feature set with placeholder values
+
+    Arguments:
+        axes: tuple of the features drawn
+        radial_max: end of the radial axes, see display_ranges
+    Returns:
+        Figure as a plain dict, used as the template by create_polar
+    """
+    # Features are spread evenly around the circle
+    theta = [45 + 360.0 * i / len(axes) for i in range(len(axes))]
     fig = make_subplots(rows=1,cols=2,shared_yaxes= True,
                         specs=[[{'type': 'polar'}]*2],
                         subplot_titles=("Selected Record","Represented Class"))
 
-    sample_df1 = df.iloc[row:row+1]
-    sample_df2 = df_norm.iloc[row:row+1]
-    target_class = sample_df1['target'].values[0]
-    #print(target_class,target_options[target_class]['label'])
-    filtered_df = df[df['target']==target_class]
-    filtered_df2 = df_norm[df_norm['target']==target_class]
-    category_avg = filtered_df2.mean(axis=0).tolist()
-    category_avg = [ round(elem, 2) for elem in category_avg ]
-
-    print(filtered_df)
-    print(category_avg)
     [fig.add_trace(go.Barpolar(
-                    r=list(sample_df2.loc[:,'sepal length':'petal width'].values)[0],
-                    theta=[45,135,225,270],
+                    r=[0]*len(axes),
+                    theta=theta,
                     #width=[15,15,15,15],
-                    marker_color=["#E4FF87", '#70DDFF', '#709BFF', '#FFAA70'],
+                    marker_color=palette(len(axes)),
                     marker_line_color="black",
                     marker_line_width=2,
-                    text = list(sample_df2.loc[:,'sepal length':'petal width'].columns),
+                    text = list(axes),
                     hoverinfo = "text",
                     opacity=0.8
         ),row=1,col=1)]
 
     [fig.add_trace(go.Barpolar(
 
-                    r=category_avg[0:4],
-                    theta=[45,135,225,270],
+                    r=[0]*len(axes),
+                    theta=theta,
                     #width=[15,15,15,15],
-                    marker_color=["#E4FF87", '#70DDFF', '#709BFF', '#FFAA70'],
+                    marker_color=palette(len(axes)),
                     marker_line_color="black",
                     marker_line_width=2,
-                    text = list(sample_df2.loc[:,'sepal length':'petal width'].columns),
+                    text = list(axes),
                     hoverinfo = "text",
                     #hovertext = "text",
                     opacity=0.8
         ),row=1,col=2)]
-    title = "Comparison of Record \""+str(row)+"\" Vs \"" + target_options[target_class]['label']+ "\" Average"
-    fig.update_layout(title=title,
+    fig.update_layout(title="",
     template=None,
     paper_bgcolor='rgba(233,233,233,0)',
     plot_bgcolor='rgba(255,233,0,0)',
     height = 500,
 
     polar = dict(
-    radialaxis = dict(range=[0, 7], showticklabels=False, ticks=''),
+    radialaxis = dict(range=[0, radial_max], showticklabels=False, ticks=''),
     angularaxis = dict(showticklabels=True, ticks=''),
     angularaxis_categoryarray = ["d", "a", "c", "b"]),
 
     polar2 = dict(
-    radialaxis = dict(range=[0, 7], showticklabels=False, ticks=''),
+    radialaxis = dict(range=[0, radial_max], showticklabels=False, ticks=''),
     angularaxis = dict(showticklabels=True, ticks='')),
     showlegend=False
     )
 
+    return json.loads(fig.to_json())
 
-    return fig
+
+def create_polar(row, target_class=None, dataset=None, cohort=None):
+    """
+    Function to create the polar-bar chart_box
+
+    Only the per-row values are written into a copy of the precompiled
+    template, so no graph_objs are constructed or validated per call.
+
+    Arguments:
+        row: Selected row
+        target_class: class of the row, looked up when not given
+        dataset: data snapshot, the current one when not given
+        cohort: aggregates of the cohort compared with, see cohorts.cohort_stats;
+            the class of the row when not given
+    Returns:
+        Figure dict
+    """
+    dataset = dataset or current()
+    df = dataset.df
+    if target_class is None:
+        target_class = int(dataset.df['target'].iat[row])
+    # Class average and top features looked up from the precomputed class index
+    entry = dataset.class_index[target_class]
+    category_avg = [entry['norm_mean'][i] for i in entry['top']]
+    title = "Comparison of Record \""+str(row)+"\" Vs \"" + dataset.labels[target_class]+ "\" Average"
+    if cohort is not None:
+        category_avg = [cohort['norm_mean'][axis] for axis in entry['top_axes']]
+        title = "Comparison of Record \""+str(row)+"\" Vs \"" + cohort['label'] + "\" Average<br>" + \
+            "{} records, {} quartiles {}".format(cohort['rows'], cohort['column'], " / ".join(
+                "{:.2f}".format(value) for value in cohort['quantiles'].values()))
+
+    template = build_polar_template(tuple(entry['top_axes']), display_ranges(dataset)[0])
+    record_trace, class_trace = template['data']
+    layout = template['layout']
+    return {'data': [dict(record_trace, r=[float(rounded(float(df[axis].iat[row]) + dataset.offset)) for axis in entry['top_axes']]),
+                     dict(class_trace, r=category_avg)],
+            'layout': dict(layout, title=dict(layout['title'], text=title))}
 
 # fig2 = create_polar(0)
 
-def create_pairwise():
+def sample_rows(dataset, max_points, seed=0):
+    """
+    Function to draw a stratified per-class sample of row positions
+
+    Every class keeps its share of the rows (and at least one row), so
+    small classes stay visible in the sampled scatter matrix.
+
+    Arguments:
+        dataset: data snapshot
+        max_points: total number of rows to keep
+        seed: seed of the random generator, fixed so the figure is reproducible
+    Returns:
+        Sorted array of row positions
+    """
+    rng = np.random.RandomState(seed)
+    n = len(dataset.df)
+    samples = []
+    for entry in dataset.class_index.values():
+        rows = entry['rows']
+        k = min(len(rows), max(1, int(round(max_points * len(rows) / float(n)))))
+        samples.append(rng.choice(rows, k, replace=False))
+    return np.sort(np.concatenate(samples))
+
+
+def create_pairwise_density(bins=PAIRWISE_BINS, dataset=None):
+    """
+    Function to create the Pair-wise comparison as 2D histograms
+
+    The lower triangle shows one heatmap of binned counts per pair of
+    attributes and the diagonal a histogram per attribute, so the payload
+    only depends on the number of bins.
+
+    Arguments:
+        bins: number of bins along each attribute
+        dataset: data snapshot, the current one when not given
+    Returns:
+        Figure object
+    """
+    dataset = dataset or current()
+    axes = dataset.top_axes
+    n = len(axes)
+    values = dataset.df[axes].values.astype(np.float64)
+    edges = [np.linspace(col.min(), col.max(), bins + 1) for col in values.T]
+    centers = [(e[:-1] + e[1:]) / 2 for e in edges]
+
+    fig = make_subplots(rows=n, cols=n, shared_xaxes=True,
+                        horizontal_spacing=0.02, vertical_spacing=0.02)
+    for i in range(n):
+        for j in range(i + 1):
+            if i == j:
+                counts, _ = np.histogram(values[:, j], bins=edges[j])
+                fig.add_trace(go.Bar(x=centers[j], y=counts, marker_color='grey',
+                                     hoverinfo='x+y', name=axes[j]), row=i + 1, col=j + 1)
+            else:
+                counts, _, _ = np.histogram2d(values[:, i], values[:, j], bins=[edges[i], edges[j]])
+                fig.add_trace(go.Heatmap(x=centers[j], y=centers[i], z=counts,
+                                         coloraxis='coloraxis', name=axes[i] + " / " + axes[j]),
+                              row=i + 1, col=j + 1)
+        fig.update_yaxes(title_text=axes[i], row=i + 1, col=1)
+        fig.update_xaxes(title_text=axes[i], row=n, col=i + 1)
+
+    fig.update_layout(
+        width=700,
+        height=600,
+        showlegend=False,
+        coloraxis={'colorscale': 'Viridis'},
+        paper_bgcolor='rgba(233,233,233,0)',
+        plot_bgcolor='rgba(255,233,0,0)',
+        )
+    return fig
+
+
+def create_pairwise(max_points=PAIRWISE_MAX_POINTS, mode=PAIRWISE_MODE, dataset=None):
     """
     Function to create the Pair-wise Scatter matrix
 
-    Arguments:None
+    Up to max_points rows every record is drawn. Beyond that the figure
+    either plots a stratified per-class sample without marker outlines
+    (mode "sample") or switches to 2D histograms (mode "density"), so the
+    payload stays bounded whatever the size of the dataset.
+
+    Arguments:
+        max_points: number of rows drawn before sampling or binning kicks in
+        mode: "sample" or "density"
+        dataset: data snapshot, the current one when not given
     Returns:
         Figure object
     """
 
+    dataset = dataset or current()
+    df = dataset.df
+    axes = dataset.top_axes
+    if len(df) > max_points and mode == 'density':
+        return create_pairwise_density(dataset=dataset)
+
+    marker_line = dict(line_color='grey', line_width=0.5)
+    if len(df) > max_points:
+        rows = sample_rows(dataset, max_points)
+        sample_df = df.iloc[rows]
+        # Outlines are drawn per point and dominate rendering at this size
+        marker_line = dict(line_width=0)
+    else:
+        sample_df = df
+
     fig = go.Figure(data=go.Splom(
-                dimensions=[dict(label=axes[0],
-                                 values=df[axes[0]]),
-                            dict(label=axes[1],
-                                values=df[axes[1]]),
-                            dict(label=axes[2],
-                                values=df[axes[2]]),
-                            dict(label=axes[3],
-                                values=df[axes[3]])],
+                dimensions=[dict(label=axis,
+                                 values=rounded(sample_df[axis].values)) for axis in axes],
                 showupperhalf=False,
                 #diagonal_visible=False,# remove plots on diagonal
                 text=axes,
                 marker=dict(
-                            color=df["target"],
+                            color=sample_df["target"],
                             showscale=True,
                             #showlegend=True,
                             #colorscale = 'Bluered',
-                            line_color='grey', line_width=0.5)
+                            **marker_line)
                 ))
 
     fig.update_layout(
@@ -154,66 +301,400 @@ def create_pairwise():
 
 # fig5 = create_pairwise()
 
-def create_gauge(row):
+@lru_cache(maxsize=None)
+def build_gauge_template(axes, limit):
 
     """
-    Function to create the 8 Gauge chart subplots
+    Function to build the Gauge chart subplots once per feature set with placeholder values
+
+    The record gauges fill the first ceil(k/4) rows of the grid and the
+    class gauges the same number of rows below them.
 
     Arguments:
-        row: Selected row
+        axes: tuple of the features drawn
+        limit: gauges range from -limit to limit, see display_ranges
     Returns:
-        Figure object
+        Figure as a plain dict, used as the template by create_gauge
     """
 
-    fig = make_subplots(rows=2,cols=4,
-                            specs=[[{"type": "indicator"}, {"type": "indicator"},{"type": "indicator"}, {"type": "indicator"}],
-                                [{"type": "indicator"}, {"type": "indicator"},{"type": "indicator"}, {"type": "indicator"}]],
-                            subplot_titles=[axes[0]+"-record",axes[1]+"-record",axes[2]+"-record",axes[3]+"-record",
-                                            axes[0]+"-class",axes[1]+"-class",axes[2]+"-class",axes[3]+"-class"]
+    n = len(axes)
+    cols = min(n, GAUGE_COLUMNS)
+    rows = int(math.ceil(n / float(cols)))
+    cell = lambda i: (i // cols + 1, i % cols + 1)
+    fig = make_subplots(rows=2*rows,cols=cols,
+                            specs=[[{"type": "indicator"} if (r % rows) * cols + c < n else None for c in range(cols)]
+                                   for r in range(2*rows)],
+                            subplot_titles=[axis+"-record" for axis in axes] + [axis+"-class" for axis in axes]
                          )
 
-    sample_df1 = df.iloc[row:row+1]
-    sample_df2 = df_norm.iloc[row:row+1]
-    target_class = sample_df1['target'].values[0]
-    filtered_df = df[df['target']==target_class]
-    filtered_df2 = df_norm[df_norm['target']==target_class]
-    category_avg = filtered_df.mean(axis=0).tolist()
-    category_avg = [ round(elem, 2) for elem in category_avg ]
-
-    c = [1,2,3,4]
-    colors = ["#E4FF87", '#70DDFF', '#709BFF', '#FFAA70']
-    for i,axis in zip(c,axes):
+    colors = palette(n)
+    for i,axis in enumerate(axes):
         [fig.add_trace(go.Indicator(
             mode = "gauge+number+delta",
-            value = float(sample_df1[axis]) ,
+            value = 0,
             domain = {'x': [0,1], 'y': [0,1]},
-            delta = {'reference': float(category_avg[i-1]), 'increasing': {'color': "RebeccaPurple"}},
-            gauge = {'bar':{'color':colors[i-1]},
-                    'axis': {'range': [-4, 4]}}
+            delta = {'reference': 0, 'increasing': {'color': "RebeccaPurple"}},
+            gauge = {'bar':{'color':colors[i]},
+                    'axis': {'range': [-limit, limit]}}
                     # 'steps': [
                     #     {'range': [-4, 0], 'color': 'white'},
                     #     {'range': [0.1, 4], 'color': 'red'}]}
             #title = {'text': axis})
-            ),row=1,col=i)]
-    for i,axis in zip(c,axes):
+            ),row=cell(i)[0],col=cell(i)[1])]
+    for i,axis in enumerate(axes):
         [fig.add_trace(go.Indicator(
         mode = "gauge+number",
-        value = float(category_avg[i-1]) ,
+        value = 0,
         domain = {'x': [0,1], 'y': [0,1]},
-            gauge = {'bar':{'color':colors[i-1]},
-                    'axis': {'range': [-4, 4]}},
+            gauge = {'bar':{'color':colors[i]},
+                    'axis': {'range': [-limit, limit]}},
         delta = {'reference': 0, 'increasing': {'color': "RebeccaPurple"}},
         #title = {'text': axis})
-        ),row=2,col=i)]
+        ),row=rows+cell(i)[0],col=cell(i)[1])]
 
     fig.update_layout(paper_bgcolor='rgba(233,233,233,0)',
     plot_bgcolor='rgba(255,233,0,0)')
-    for i in range(0,8):
+    if rows > 1:
+        fig.update_layout(height=225*2*rows)
+    for i in range(0,2*n):
         fig.layout.annotations[i]["font"] = {'size': 12}
 
-    return fig
+    return json.loads(fig.to_json())
+
+
+def create_gauge(row, target_class=None, dataset=None, cohort=None):
+
+    """
+    Function to create the Gauge chart subplots of the class's top features
+
+    The record gauges get the row's values and the class average as delta
+    reference, the class gauges get the class average; everything else
+    is shared with the precompiled template.
+
+    Arguments:
+        row: Selected row
+        target_class: class of the row, looked up when not given
+        dataset: data snapshot, the current one when not given
+        cohort: aggregates of the cohort compared with, see cohorts.cohort_stats;
+            the class of the row when not given
+    Returns:
+        Figure dict
+    """
+
+    dataset = dataset or current()
+    df = dataset.df
+    if target_class is None:
+        target_class = int(df['target'].iat[row])
+    # Class average and top features looked up from the precomputed class index
+    entry = dataset.class_index[target_class]
+    axes = entry['top_axes']
+    category_avg = [entry['mean'][i] for i in entry['top']]
+    if cohort is not None:
+        category_avg = [cohort['mean'][axis] for axis in axes]
+
+    template = build_gauge_template(tuple(axes), display_ranges(dataset)[1])
+    n = len(axes)
+    record_traces = template['data'][:n]
+    class_traces = template['data'][n:]
+    data = []
+    for trace, axis, avg in zip(record_traces, axes, category_avg):
+        data.append(dict(trace, value=float(rounded(df[axis].iat[row])),
+                         delta=dict(trace['delta'], reference=float(avg))))
+    for trace, avg in zip(class_traces, category_avg):
+        data.append(dict(trace, value=float(avg)))
+
+    return {'data': data, 'layout': template['layout']}
 
     # fig4 = create_gauge(0)
+
+def create_class_label(target_class, dataset=None):
+    """
+    Function to create the text displaying the class of the selected record
+
+    Arguments:
+        target_class: class of the selected record
+        dataset: data snapshot, the current one when not given
+    Returns:
+        Class value as string
+    """
+    dataset = dataset or current()
+    return 'Class of selected record: "{}"'.format(dataset.labels[target_class])
+
+
+def create_row_outputs(row, dataset=None, cohort=None):
+    """
+    Function to create every Tab 3 output for a row with a single lookup
+
+    Arguments:
+        row: Selected row
+        dataset: data snapshot, the current one when not given
+        cohort: aggregates of the cohort compared with, the row's class when not given
+    Returns:
+        List with the polar figure, gauge figure and class label
+    """
+    dataset = dataset or current()
+    target_class = int(dataset.df['target'].iat[row])
+    return [create_polar(row, target_class, dataset, cohort), create_gauge(row, target_class, dataset, cohort),
+            create_class_label(target_class, dataset)]
+
+
+def create_box(class_data, max_points=BOX_MAX_POINTS, dataset=None):
+    """
+    Function to create the class-specific box plot
+
+    Up to max_points rows, every value is sent and Plotly computes the
+    boxes in the browser. Beyond that, each box is drawn from its
+    precomputed quartiles and fences, with its outliers as a scatter
+    trace, so the payload no longer grows with the class.
+
+    Arguments:
+        class_data: entry of the class index for the selected class
+        max_points: number of rows drawn as points
+        dataset: data snapshot the entry belongs to, the current one when not given
+    Returns:
+        Figure object
+    """
+    if len(class_data['rows']) > max_points:
+        return create_box_from_stats(class_data, max_points)
+    _, values, _ = class_values(class_data, dataset or current())
+    traces=[]
+
+    for axis in class_data['top_axes']:
+        [traces.append(go.Box(
+            #x=filtered_df['shift'],
+            y=values[axis],
+            name=axis
+            ))]
+
+    return {'data':traces, 'layout':BOX_LAYOUT}
+
+
+def create_box_from_stats(class_data, max_outliers=BOX_MAX_POINTS):
+    """
+    Function to create the class-specific box plot from precomputed statistics
+
+    Arguments:
+        class_data: entry of the class index for the selected class
+        max_outliers: outliers drawn per feature, evenly spread over their
+            sorted values so the most extreme ones are kept
+    Returns:
+        Figure object
+    """
+    traces=[]
+    colors = qualitative.Plotly
+    for i, axis in enumerate(class_data['top_axes']):
+        stats = class_data['box'][axis]
+        color = colors[i % len(colors)]
+        traces.append(go.Box(
+            x=[axis],
+            q1=[stats['q1']], median=[stats['median']], q3=[stats['q3']],
+            lowerfence=[stats['lowerfence']], upperfence=[stats['upperfence']],
+            boxpoints=False,
+            marker_color=color,
+            legendgroup=axis,
+            name=axis
+            ))
+        outliers = np.sort(stats['outliers'])
+        if len(outliers) > max_outliers:
+            outliers = outliers[np.linspace(0, len(outliers) - 1, max_outliers).round().astype(int)]
+        traces.append(go.Scatter(
+            x=[axis]*len(outliers),
+            y=outliers,
+            mode='markers',
+            marker=dict(color=color, size=4),
+            hoverinfo='y',
+            legendgroup=axis,
+            showlegend=False,
+            name=axis
+            ))
+
+    return {'data':traces, 'layout':BOX_LAYOUT}
+
+
+def class_values(class_data, dataset):
+    """
+    Function to read the values drawn for a class from the frame, rounded as displayed
+
+    Arguments:
+        class_data: entry of the class index
+        dataset: data snapshot the entry belongs to
+    Returns:
+        Tuple of the shift, and the SHAP values and bubble sizes of every
+        top feature keyed by feature
+    """
+    rows = class_data['rows']
+    df = dataset.df
+    top_values = {axis: df[axis].values[rows].astype(np.float64) for axis in class_data['top_axes']}
+    return (rounded(df['shift'].values[rows]),
+            {axis: rounded(elem) for axis, elem in top_values.items()},
+            {axis: 10 * rounded(elem + dataset.offset) for axis, elem in top_values.items()})
+
+
+def bin_bubbles(class_data, bins=BUBBLE_BINS, dataset=None):
+    """
+    Function to bin the bubbles of every top feature of a class in one pass
+
+    All the features share one grid: shift along x, SHAP value along y.
+
+    Arguments:
+        class_data: entry of the class index for the selected class
+        bins: number of bins along each axis
+        dataset: data snapshot the entry belongs to, the current one when not given
+    Returns:
+        Tuple of the x and y bin centers and two (features, bins, bins)
+        arrays, the rows per cell and their mean bubble size
+    """
+    axes = class_data['top_axes']
+    shift, class_shap, class_sizes = class_values(class_data, dataset or current())
+    values = np.column_stack([class_shap[axis] for axis in axes])
+    sizes = np.column_stack([class_sizes[axis] for axis in axes])
+    x_edges = np.linspace(shift.min(), shift.max(), bins + 1)
+    y_edges = np.linspace(values.min(), values.max(), bins + 1)
+    xi = np.clip(np.searchsorted(x_edges, shift, side='right') - 1, 0, bins - 1)
+    yi = np.clip(np.searchsorted(y_edges, values, side='right') - 1, 0, bins - 1)
+    # One flat cell number per value, so a single bincount covers every feature
+    cells = ((np.arange(len(axes)) * bins + xi[:, None]) * bins + yi).ravel()
+    counts = np.bincount(cells, minlength=len(axes) * bins * bins)
+    size_sums = np.bincount(cells, weights=sizes.ravel(), minlength=len(axes) * bins * bins)
+    mean_sizes = size_sums / np.maximum(counts, 1)
+    shape = (len(axes), bins, bins)
+    return ((x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2,
+            counts.reshape(shape), mean_sizes.reshape(shape))
+
+
+def create_binned_bubble(class_data, bins=BUBBLE_BINS, dataset=None):
+    """
+    Function to create the class-specific bubble chart from binned values
+
+    Each non-empty cell of the grid is one bubble, sized by the mean
+    bubble size of its rows, so there are at most bins x bins markers
+    per feature whatever the size of the class.
+
+    Arguments:
+        class_data: entry of the class index for the selected class
+        bins: number of bins along each axis
+        dataset: data snapshot the entry belongs to, the current one when not given
+    Returns:
+        Figure object
+    """
+    x_centers, y_centers, counts, mean_sizes = bin_bubbles(class_data, bins, dataset)
+    traces2=[]
+
+    for i, axis in enumerate(class_data['top_axes']):
+        xi, yi = np.nonzero(counts[i])
+        traces2.append(go.Scatter(
+            x=rounded(x_centers[xi]),
+            y=rounded(y_centers[yi]),
+            text=["shift, {}: {} records".format(axis, count) for count in counts[i][xi, yi].tolist()],
+            mode='markers',
+            opacity=0.7,
+            marker=dict(size=rounded(mean_sizes[i][xi, yi])),
+            name=axis
+            ))
+
+    return {'data':traces2, 'layout':BUBBLE_LAYOUT}
+
+
+def create_bubble(class_data, max_points=BUBBLE_MAX_POINTS, dataset=None):
+    """
+    Function to create the class-specific bubble chart of SHAP values against shift
+
+    Classes of more than max_points rows are binned, see create_binned_bubble.
+
+    Arguments:
+        class_data: entry of the class index for the selected class
+        max_points: number of rows drawn as markers
+        dataset: data snapshot the entry belongs to, the current one when not given
+    Returns:
+        Figure object
+    """
+    if len(class_data['rows']) > max_points:
+        return create_binned_bubble(class_data, dataset=dataset)
+    shift, values, sizes = class_values(class_data, dataset or current())
+    traces2=[]
+
+    for axis in class_data['top_axes']:
+        [traces2.append(go.Scatter(
+            x=shift,
+            y=values[axis],
+            text=["shift, "+axis],
+            mode='markers',
+            opacity=0.7,
+            marker=dict(size=sizes[axis]),
+            name=axis
+            ))]
+
+    return {'data':traces2, 'layout':BUBBLE_LAYOUT}
+
+
+def create_placeholder(text="Building the figure..."):
+    """
+    Function to create the figure shown while the real one is being built
+
+    Arguments:
+        text: message displayed in the middle of the plot area
+    Returns:
+        Figure dict
+    """
+    return {'data': [],
+            'layout': {'xaxis': {'visible': False}, 'yaxis': {'visible': False},
+                       'annotations': [{'text': text, 'showarrow': False, 'font': {'size': 16}}],
+                       'paper_bgcolor': 'rgba(233,233,233,0)', 'plot_bgcolor': 'rgba(255,233,0,0)'}}
+
+
+def build_client_payload(dataset=None):
+    """
+    Function to build the compact data shipped to the browser for the clientside callbacks
+
+    The arrays are the same ones the server-side builders read, and the
+    templates are the same precompiled figures, so both modes render
+    identical charts.
+
+    Arguments:
+        dataset: data snapshot, the current one when not given
+    Returns:
+        Dict of per-row arrays, per-class top features, means, labels and
+        figure templates
+    """
+    dataset = dataset or current()
+    df, class_index = dataset.df, dataset.class_index
+    radial_max, limit = display_ranges(dataset)
+    # Only the features drawn for some class are shipped
+    drawn = set(axis for entry in class_index.values() for axis in entry['top_axes'])
+    axes = [axis for axis in dataset.axes if axis in drawn]
+    return {
+        'axes': axes,
+        'labels': {str(cls): label for cls, label in dataset.labels.items()},
+        'target': df['target'].astype(int).tolist(),
+        'shift': rounded(df['shift'].values).tolist(),
+        'shap': {axis: rounded(df[axis].values).tolist() for axis in axes},
+        'norm': {axis: rounded(df[axis].values.astype(np.float64) + dataset.offset).tolist() for axis in axes},
+        'top': {str(cls): entry['top_axes'] for cls, entry in class_index.items()},
+        'mean': {str(cls): [entry['mean'][i] for i in entry['top']] for cls, entry in class_index.items()},
+        'norm_mean': {str(cls): [entry['norm_mean'][i] for i in entry['top']] for cls, entry in class_index.items()},
+        'templates': {
+            'polar': {str(cls): build_polar_template(tuple(entry['top_axes']), radial_max) for cls, entry in class_index.items()},
+            'gauge': {str(cls): build_gauge_template(tuple(entry['top_axes']), limit) for cls, entry in class_index.items()},
+            'box': json.loads(json.dumps(BOX_LAYOUT.to_plotly_json(), cls=PlotlyJSONEncoder)),
+            'bubble': json.loads(json.dumps(BUBBLE_LAYOUT.to_plotly_json(), cls=PlotlyJSONEncoder)),
+        },
+    }
+
+
+BOX_LAYOUT = go.Layout(title='Class-specific Comparison between Attributes (Box Plot)',
+                        #xaxis={'title':'Shift'},
+                        yaxis={'title':'SHAP value'},
+                            hovermode='closest',
+                            paper_bgcolor='rgba(233,233,233,0)',
+                            plot_bgcolor='rgba(255,233,0,0)')
+
+BUBBLE_LAYOUT = go.Layout(title='Class-specific Comparison between Attributes (Bubble Chart)',
+                        xaxis={'title':'Shift'},
+                        yaxis={'title':'SHAP value'},
+                            hovermode='closest',
+                             paper_bgcolor='rgba(233,233,233,0)',
+                             plot_bgcolor='rgba(255,233,0,0)')
+
 # def create_table(row):
 #     initial_table = df_table.iloc[row:row+1]
 #     target_class = initial_table['target'].values[0]